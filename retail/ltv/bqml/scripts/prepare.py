@@ -0,0 +1,188 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Computes the PrepareForML training table from the aggregated orders.
+
+Takes the per customer per day aggregates (the table for predicting) and
+computes the features and targets of all the threshold dates of
+20_procedure_prepare.sql in a single vectorized pass. Orders are sorted by
+customer and day, and every window is a range of cumulative sums per customer.
+"""
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+AGGRED_COLUMNS = [
+  'customer_id', 'order_day', 'value', 'qty_articles', 'num_returns', 'time_to_return']
+FEATURED_COLUMNS = [
+  'customer_id', 'monetary', 'frequency', 'recency', 'T', 'time_between',
+  'avg_basket_value', 'avg_basket_size', 'has_returns', 'avg_time_to_return',
+  'num_returns', 'target_monetary']
+
+
+def _round(values, decimals=2):
+  """Rounds half away from zero, like BigQuery ROUND."""
+  scale = 10. ** decimals
+  return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
+
+
+def get_threshold_days(min_day, max_day, window_step, window_step_initial):
+  """Returns the threshold dates of the PrepareForML loop, as day numbers."""
+  first_day = min_day + window_step_initial
+  last_day = max_day - window_step
+  if first_day >= last_day:
+    return np.array([], dtype=np.int64)
+  return np.arange(first_day, last_day, window_step, dtype=np.int64)
+
+
+def prepare_for_ml(aggred, window_length, window_step, window_step_initial, length_future):
+  """Computes the features and target of each customer for each threshold date.
+
+  Args:
+    aggred: A DataFrame with the columns of the Aggred table.
+    window_length: How many days back for inputs transactions, or 0 for all.
+    window_step: How many days between thresholds.
+    window_step_initial: How many days for the first window.
+    length_future: How many days to predict for.
+
+  Returns:
+    A DataFrame with the columns of the Featured table, with the rows of the
+    first threshold date first.
+  """
+  customers, customer_idx = np.unique(aggred['customer_id'].values, return_inverse=True)
+  days = pd.to_datetime(aggred['order_day']).values.astype('datetime64[D]').astype(np.int64)
+  order = np.lexsort((days, customer_idx))
+  customer_idx, days = customer_idx[order], days[order]
+  # Values are rounded to cents and quantities are integers, so their sums are
+  # computed in integers and do not drift with the length of the cumsum.
+  value_cents = np.rint(aggred['value'].values[order].astype(np.float64) * 100).astype(np.int64)
+  qty_articles = aggred['qty_articles'].values[order].astype(np.int64)
+  num_returns = aggred['num_returns'].values[order].astype(np.int64)
+  time_to_return = aggred['time_to_return'].values[order].astype(np.float64)
+  has_time_to_return = ~np.isnan(time_to_return)
+
+  # Cumulative sums with a leading zero, so that the sum over the rows in
+  # [start, end) is cumsum[end] - cumsum[start].
+  def _cumsum(values):
+    return np.concatenate([[0], np.cumsum(values)])
+  value_cumsum = _cumsum(value_cents)
+  qty_cumsum = _cumsum(qty_articles)
+  returns_cumsum = _cumsum(num_returns)
+  time_to_return_cumsum = _cumsum(np.where(has_time_to_return, time_to_return, 0.))
+  time_to_return_count = _cumsum(has_time_to_return)
+
+  # Rows are sorted by (customer, day), so a window of days of a customer is
+  # found by binary search on a combined key.
+  day_range = days.max() - days.min() + length_future + max(window_length, 0) + 2
+  day_offset = days.min() - max(window_length, 0) - 1
+  keys = customer_idx * day_range + (days - day_offset)
+  customer_starts = np.searchsorted(customer_idx, np.arange(len(customers)))
+
+  def _find(day, side):
+    return np.searchsorted(keys, np.arange(len(customers)) * day_range + (day - day_offset), side=side)
+
+  min_day, max_day = days.min(), days.max()
+  featured = []
+  for threshold_day in get_threshold_days(min_day, max_day, window_step, window_step_initial):
+    if window_length != 0:
+      start = _find(threshold_day - window_length, 'left')
+    else:
+      start = customer_starts
+    end = _find(threshold_day, 'right')
+    target_end = _find(threshold_day + length_future, 'right')
+
+    count = end - start
+    valid = count > 0
+    start, end, target_end, count = start[valid], end[valid], target_end[valid], count[valid]
+
+    monetary = (value_cumsum[end] - value_cumsum[start]) / 100
+    recency = days[end - 1] - days[start]
+    returns = returns_cumsum[end] - returns_cumsum[start]
+    time_to_return_counts = time_to_return_count[end] - time_to_return_count[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      avg_time_to_return = np.ceil(
+        (time_to_return_cumsum[end] - time_to_return_cumsum[start]) / time_to_return_counts)
+    avg_time_to_return[time_to_return_counts == 0] = np.nan
+
+    featured.append(pd.DataFrame({
+      'customer_id': customers[valid],
+      'monetary': _round(monetary),
+      'frequency': count,
+      'recency': recency,
+      'T': threshold_day - days[start],
+      'time_between': _round(recency / count),
+      'avg_basket_value': _round(monetary / count),
+      'avg_basket_size': _round((qty_cumsum[end] - qty_cumsum[start]) / count),
+      'has_returns': np.where(returns > 0, 'y', 'n'),
+      'avg_time_to_return': avg_time_to_return,
+      'num_returns': returns,
+      # The target is the value of all orders up to the end of the future
+      # window, not only the ones after the threshold date.
+      'target_monetary': _round(
+        (value_cumsum[target_end] - value_cumsum[customer_starts[valid]]) / 100),
+    }))
+    logging.info(f'{valid.sum()} customers with orders before day {threshold_day}.')
+
+  if not featured:
+    return pd.DataFrame(columns=FEATURED_COLUMNS)
+  return pd.concat(featured, ignore_index=True)[FEATURED_COLUMNS]
+
+
+def get_args():
+
+  args_parser = argparse.ArgumentParser()
+
+  args_parser.add_argument(
+    '--aggred-file',
+    help='CSV export of the table for predicting (the Aggred table)',
+    required=True
+  )
+
+  args_parser.add_argument(
+    '--output-file',
+    help='CSV file to write the table for training to',
+    required=True
+  )
+
+  args_parser.add_argument(
+    '--predicting-file',
+    help='[Optional] CSV file to write the table for predicting to, which is the input as is',
+    default=None
+  )
+
+  args_parser.add_argument('--window-length', default=0, type=int)
+  args_parser.add_argument('--window-step', default=30, type=int)
+  args_parser.add_argument('--window-step-initial', default=90, type=int)
+  args_parser.add_argument('--length-future', default=30, type=int)
+
+  return args_parser.parse_args()
+
+
+def main():
+  args = get_args()
+  aggred = pd.read_csv(args.aggred_file, usecols=AGGRED_COLUMNS)
+  logging.info(f'{len(aggred)} aggregated orders are loaded.')
+  featured = prepare_for_ml(
+    aggred, args.window_length, args.window_step, args.window_step_initial, args.length_future)
+  featured.to_csv(args.output_file, index=False)
+  if args.predicting_file:
+    aggred.to_csv(args.predicting_file, index=False)
+  logging.info(f'{len(featured)} training rows are written to {args.output_file}.')
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main()
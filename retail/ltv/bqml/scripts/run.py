@@ -0,0 +1,395 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs the LTV procedures of run.sh with the BigQuery client.
+
+Stages run as soon as the stages they depend on are done, so the example
+tables load and the procedures deploy concurrently. A stage is skipped when its
+statement, parameters and source tables are unchanged since its last successful
+run and its outputs still exist. The duration and bytes processed of each stage
+are appended to a local run report.
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from google.cloud import bigquery
+from google.api_core import exceptions
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_DATA_URIS = {
+  'crm': 'gs://solutions-public-assets/analytics-componentized-patterns/ltv/crm.csv',
+  'sales': 'gs://solutions-public-assets/analytics-componentized-patterns/ltv/sales_*',
+}
+PROCEDURE_FILES = {
+  'PersistData': '00_procedure_persist.sql',
+  'MatchFields': '10_procedure_match.sql',
+  'PrepareForML': '20_procedure_prepare.sql',
+  'TrainLTV': '30_procedure_train.sql',
+  'PredictLTV': '40_procedure_predict.sql',
+  'ExtractTopEmails': '50_procedure_top.sql',
+}
+
+
+class Stage(object):
+  """A step of the flow.
+
+  Args:
+    name: Name of the stage in the state and the report.
+    run: Function that takes the client and returns the finished job.
+    statement: Text that defines what the stage does, such as its SQL.
+    deps: Names of the stages that must be done before this one.
+    sources: Tables and models read by the stage, as ('table'|'model', id).
+    outputs: Tables, models and routines written by the stage, as
+      ('table'|'model'|'routine', id).
+  """
+
+  def __init__(self, name, run, statement, deps=(), sources=(), outputs=()):
+    self.name = name
+    self.run = run
+    self.statement = statement
+    self.deps = list(deps)
+    self.sources = list(sources)
+    self.outputs = list(outputs)
+
+
+def _get_modified(client, kind, resource_id):
+  """Returns the last modification time of a resource, or None if it does not exist."""
+  get = {'table': client.get_table, 'model': client.get_model, 'routine': client.get_routine}[kind]
+  try:
+    resource = get(resource_id)
+  except exceptions.NotFound:
+    return None
+  return resource.modified.isoformat()
+
+
+def get_fingerprint(client, stage):
+  """Hashes the statement of a stage and the versions of the resources it reads.
+
+  Sources are read when the stage is about to run, after the stages it depends
+  on, so a rewritten source table or retrained model changes the fingerprint.
+  """
+  sources = [(kind, resource_id, _get_modified(client, kind, resource_id))
+             for kind, resource_id in stage.sources]
+  payload = json.dumps({'statement': stage.statement, 'sources': sources}, sort_keys=True)
+  return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _get_job_stats(job):
+  if job is None:
+    return {}
+  if isinstance(job, bigquery.LoadJob):
+    return {'job_id': job.job_id, 'output_bytes': job.output_bytes}
+  return {
+    'job_id': job.job_id,
+    'bytes_processed': job.total_bytes_processed,
+    'bytes_billed': job.total_bytes_billed,
+    'slot_millis': job.slot_millis,
+  }
+
+
+def run_stage(client, stage, fingerprint, previous_fingerprint, force):
+  outputs_exist = all(
+    _get_modified(client, kind, resource_id) is not None for kind, resource_id in stage.outputs)
+  if not force and fingerprint == previous_fingerprint and outputs_exist:
+    print(f'Skipping {stage.name}, its inputs are unchanged.')
+    return {'stage': stage.name, 'status': 'skipped', 'duration': 0.}
+
+  print(f'Running {stage.name}...')
+  start_time = time.time()
+  job = stage.run(client)
+  duration = time.time() - start_time
+  print(f'{stage.name} is done in {duration:.1f}s.')
+  result = {'stage': stage.name, 'status': 'done', 'duration': duration}
+  result.update(_get_job_stats(job))
+  return result
+
+
+def run_stages(client, stages, state, save_state, results, max_workers, force=False):
+  """Runs each stage once the stages it depends on are done.
+
+  The state, which maps stage names to the fingerprint of their last successful
+  run, is saved with save_state after each stage so that a failed run resumes
+  where it stopped. The results of the stages are appended to results in
+  completion order. When a stage fails, no other stage starts, the running
+  ones are waited for and recorded, and then the first error is raised.
+  """
+  pending = {stage.name: stage for stage in stages}
+  done = set()
+  futures = {}
+  error = None
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    while futures or (pending and error is None):
+      for name, stage in list(pending.items()):
+        if error is None and all(dep in done for dep in stage.deps):
+          try:
+            fingerprint = get_fingerprint(client, stage)
+          except Exception as fingerprint_error:
+            error = fingerprint_error
+            break
+          future = executor.submit(
+            run_stage, client, stage, fingerprint, state.get(name), force)
+          futures[future] = (name, fingerprint)
+          del pending[name]
+
+      if not futures:
+        if error is not None:
+          break
+        raise ValueError(f'Stages {list(pending)} depend on stages that do not exist.')
+      finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+      for future in finished:
+        name, fingerprint = futures.pop(future)
+        try:
+          result = future.result()
+        except Exception as stage_error:
+          error = error or stage_error
+          continue
+        results.append(result)
+        done.add(name)
+        state[name] = fingerprint
+        save_state()
+
+  if error is not None:
+    raise error
+
+
+def _query(sql, dataset_ref):
+  def run(client):
+    job_config = bigquery.QueryJobConfig(default_dataset=dataset_ref)
+    job = client.query(sql, job_config=job_config)
+    job.result()
+    return job
+  return run
+
+
+def _load(table_id, uri):
+  def run(client):
+    job_config = bigquery.LoadJobConfig(
+      source_format=bigquery.SourceFormat.CSV,
+      skip_leading_rows=1,
+      max_bad_records=100000,
+      field_delimiter=',',
+      autodetect=True,
+      write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    job = client.load_table_from_uri(uri, table_id, job_config=job_config)
+    job.result()
+    return job
+  return run
+
+
+def build_stages(args):
+  """Returns the stages of run.sh with their dependencies."""
+  dataset_ref = f'{args.project_id}.{args.dataset_id}'
+  table_aggred = f'{args.dataset_id}.aggred'
+  table_ml = f'{args.dataset_id}.ml'
+  table_predictions = f'{args.dataset_id}.predictions'
+  table_emails = f'{args.dataset_id}.top_emails'
+
+  stages = []
+
+  # Loads the example datasets if they do not exist, as run.sh does.
+  for name, table_id in [('crm', args.table_crm), ('sales', args.table_sales)]:
+    stages.append(Stage(
+      f'load_{name}',
+      lambda client, table_id=table_id, name=name: (
+        None if _get_modified(client, 'table', table_id)
+        else _load(table_id, SAMPLE_DATA_URIS[name])(client)),
+      statement=json.dumps([table_id, SAMPLE_DATA_URIS[name]]),
+      outputs=[('table', table_id)]))
+
+  for procedure, file_name in PROCEDURE_FILES.items():
+    with open(os.path.join(SCRIPTS_DIR, file_name)) as handle:
+      sql = handle.read()
+    stages.append(Stage(
+      f'store_{procedure}',
+      _query(sql, dataset_ref),
+      statement=sql,
+      outputs=[('routine', f'{dataset_ref}.{procedure}')]))
+
+  # MatchFields writes a temp table that PrepareForML reads, so both run in
+  # the same script.
+  sql = f"""
+    CALL MatchFields('{args.table_sales}');
+    CALL PrepareForML(
+      {args.max_stdv_monetary},
+      {args.max_stdv_qty},
+      {args.window_length},
+      {args.window_step},
+      {args.window_step_initial},
+      {args.length_future},
+      '{table_aggred}',
+      '{table_ml}');"""
+  stages.append(Stage(
+    'prepare',
+    _query(sql, dataset_ref),
+    statement=sql + _read_procedures('MatchFields', 'PrepareForML'),
+    deps=['load_sales', 'store_MatchFields', 'store_PrepareForML'],
+    sources=[('table', args.table_sales)],
+    outputs=[('table', table_aggred), ('table', table_ml)]))
+
+  predict_deps = ['prepare', 'store_PredictLTV']
+  if args.train_model_id != 'null':
+    sql = f"""
+      CALL TrainLTV(
+        '{args.train_model_id}',
+        '{table_ml}');"""
+    stages.append(Stage(
+      'train',
+      _query(sql, dataset_ref),
+      statement=sql + _read_procedures('TrainLTV'),
+      deps=['prepare', 'store_TrainLTV'],
+      sources=[('table', table_ml)],
+      outputs=[('model', args.train_model_id)]))
+    predict_deps.append('train')
+
+  if args.use_model_id != 'null':
+    sql = f"""
+      CALL PredictLTV(
+        '{args.use_model_id}',
+        '{table_aggred}',
+        'NULL',
+        {args.window_length},
+        '{table_predictions}');"""
+    stages.append(Stage(
+      'predict',
+      _query(sql, dataset_ref),
+      statement=sql + _read_procedures('PredictLTV'),
+      deps=predict_deps,
+      sources=[('model', args.use_model_id), ('table', table_aggred)],
+      outputs=[('table', table_predictions)]))
+
+    sql = f"""
+      DECLARE TOP_EMAILS ARRAY<STRING>;
+
+      CALL ExtractTopEmails(
+        {args.top_ltv_ratio},
+        '{table_predictions}',
+        '{args.table_crm}',
+        '{table_emails}');"""
+    stages.append(Stage(
+      'top',
+      _query(sql, dataset_ref),
+      statement=sql + _read_procedures('ExtractTopEmails'),
+      deps=['predict', 'load_crm', 'store_ExtractTopEmails'],
+      sources=[('table', table_predictions), ('table', args.table_crm)],
+      outputs=[('table', table_emails)]))
+
+  return stages
+
+
+def _read_procedures(*procedures):
+  text = ''
+  for procedure in procedures:
+    with open(os.path.join(SCRIPTS_DIR, PROCEDURE_FILES[procedure])) as handle:
+      text += handle.read()
+  return text
+
+
+def get_args():
+
+  args_parser = argparse.ArgumentParser()
+
+  args_parser.add_argument('--project-id', help='Project ID', required=True)
+  args_parser.add_argument('--dataset-id', help='Dataset ID', required=True)
+  args_parser.add_argument(
+    '--table-sales', help='Source table for transactions, [DATASET].[TABLE]', default=None)
+  args_parser.add_argument(
+    '--table-crm', help='Table with user information, [DATASET].[TABLE]', default=None)
+  args_parser.add_argument(
+    '--train-model-id',
+    help='Name of the trained model. Set to null if you do not want to train a model.',
+    default=None)
+  args_parser.add_argument(
+    '--use-model-id',
+    help='Name of the model to use for predictions. Must include dataset: [DATASET].[MODEL]',
+    default=None)
+  args_parser.add_argument('--window-length', default=0, type=int)
+  args_parser.add_argument('--window-step', default=30, type=int)
+  args_parser.add_argument('--window-step-initial', default=90, type=int)
+  args_parser.add_argument('--length-future', default=30, type=int)
+  args_parser.add_argument('--max-stdv-monetary', default=500, type=int)
+  args_parser.add_argument('--max-stdv-qty', default=100, type=int)
+  args_parser.add_argument('--top-ltv-ratio', default=0.2, type=float)
+  args_parser.add_argument(
+    '--max-workers', help='Maximum number of stages that run at the same time', default=8, type=int)
+  args_parser.add_argument(
+    '--state-file', help='File with the fingerprints of the last run of each stage',
+    default='run_state.json')
+  args_parser.add_argument(
+    '--report-file', help='File to append the report of the run to, one JSON line per run',
+    default='run_report.jsonl')
+  args_parser.add_argument(
+    '--force', help='Run all the stages, even if their inputs are unchanged', action='store_true')
+
+  args = args_parser.parse_args()
+
+  # Sets default values as run.sh does.
+  now = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+  args.train_model_id = args.train_model_id or f'{args.dataset_id}.model_{now}'
+  args.use_model_id = args.use_model_id or f'{args.dataset_id}.model_{now}'
+  args.table_sales = args.table_sales or f'{args.dataset_id}.sales'
+  args.table_crm = args.table_crm or f'{args.dataset_id}.crm'
+  return args
+
+
+def main():
+  args = get_args()
+  client = bigquery.Client(project=args.project_id)
+  client.create_dataset(f'{args.project_id}.{args.dataset_id}', exists_ok=True)
+
+  state = {}
+  if os.path.exists(args.state_file):
+    with open(args.state_file) as handle:
+      state = json.load(handle)
+  # Keeps the stages of each dataset apart, so that one state file can serve
+  # several datasets.
+  state_key = f'{args.project_id}.{args.dataset_id}'
+  stage_state = state.setdefault(state_key, {})
+
+  def save_state():
+    with open(args.state_file, 'w') as handle:
+      json.dump(state, handle, indent=2)
+
+  start_time = time.time()
+  report = {
+    'started': datetime.datetime.now().isoformat(),
+    'project_id': args.project_id,
+    'dataset_id': args.dataset_id,
+    'status': 'failed',
+  }
+  results = []
+  try:
+    run_stages(
+      client, build_stages(args), stage_state, save_state, results, args.max_workers, args.force)
+    report['status'] = 'done'
+  finally:
+    report['stages'] = results
+    report['duration'] = time.time() - start_time
+    with open(args.report_file, 'a') as handle:
+      handle.write(json.dumps(report) + '\n')
+
+  print(f'{"Stage":<28}{"Status":<10}{"Seconds":>10}{"MB processed":>16}')
+  for result in results:
+    megabytes = (result.get('bytes_processed') or 0) / 1e6
+    print(f'{result["stage"]:<28}{result["status"]:<10}{result["duration"]:>10.1f}{megabytes:>16.1f}')
+  print(f'Total: {report["duration"]:.1f}s. Report is appended to {args.report_file}.')
+
+
+if __name__ == '__main__':
+  main()
@@ -4,33 +4,115 @@ import os
 import fire
 
 def run_bigquery_ddl(project_id: str, query_string: str, location: str) -> NamedTuple(
-    'DDLOutput', [('created_table', str), ('query', str)]):
+    'DDLOutput', [('created_table', str), ('query', str), ('stats', str)]):
     """
     Runs BigQuery query and returns a table/model name
     """
     print(query_string)
         
-    from google.cloud import bigquery
-    from google.api_core.future import polling
+    import json
+    import time
     from google.cloud import bigquery
     from google.cloud.bigquery import retry as bq_retry
     
-    bqclient = bigquery.Client(project=project_id, location=location)
-    job = bqclient.query(query_string, retry=bq_retry.DEFAULT_RETRY)
-    job._retry = polling.DEFAULT_RETRY
+    TRANSIENT_ERRORS = ['backendError', 'internalError', 'rateLimitExceeded']
+    MAX_ATTEMPTS = 3
     
-    while job.running():
-        from time import sleep
-        sleep(0.1)
-        print('Running ...')
+    bqclient = bigquery.Client(project=project_id, location=location)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        job = bqclient.query(query_string, retry=bq_retry.DEFAULT_RETRY)
+        try:
+            # Long-polls the job instead of busy waiting.
+            job.result(retry=bq_retry.DEFAULT_RETRY)
+            break
+        except Exception:
+            reason = (job.error_result or {}).get('reason')
+            if reason not in TRANSIENT_ERRORS or attempt == MAX_ATTEMPTS:
+                raise
+            print('Job {} failed with {}, retrying ...'.format(job.job_id, reason))
+            time.sleep(2 ** attempt)
         
     tblname = job.ddl_target_table
     tblname = '{}.{}'.format(tblname.dataset_id, tblname.table_id)
     print('{} created in {}'.format(tblname, job.ended - job.started))
     
+    stats = {
+        'job_id': job.job_id,
+        'attempts': attempt,
+        'elapsed_seconds': (job.ended - job.started).total_seconds(),
+        'total_bytes_processed': job.total_bytes_processed,
+        'total_bytes_billed': job.total_bytes_billed,
+        'slot_millis': job.slot_millis,
+    }
+    
+    from collections import namedtuple
+    result_tuple = namedtuple('DDLOutput', ['created_table', 'query', 'stats'])
+    return result_tuple(tblname, query_string, json.dumps(stats))
+
+def run_bigquery_ddl_jobs(project_id: str, queries: str, location: str, max_attempts: int = 3) -> NamedTuple(
+    'DDLJobsOutput', [('created_tables', str), ('stats', str)]):
+    """
+    Runs independent BigQuery DDL statements concurrently
+    
+    queries is a JSON list of statements. Each statement is submitted right away
+    and waited on in its own thread, and is resubmitted with exponential backoff
+    if it fails with a transient error. Returns the JSON lists of the created
+    table/model names and of the timing and bytes processed of each job.
+    """
+    import json
+    import time
+    from concurrent import futures
+    from google.cloud import bigquery
+    from google.cloud.bigquery import retry as bq_retry
+    
+    TRANSIENT_ERRORS = ['backendError', 'internalError', 'rateLimitExceeded']
+    MAX_BACKOFF_SECONDS = 60
+    
+    queries = json.loads(queries)
+    bqclient = bigquery.Client(project=project_id, location=location)
+    
+    def run_job(query_string):
+        for attempt in range(1, max_attempts + 1):
+            job = bqclient.query(query_string, retry=bq_retry.DEFAULT_RETRY)
+            print('Job {} submitted'.format(job.job_id))
+            try:
+                # Long-polls the job instead of busy waiting.
+                job.result(retry=bq_retry.DEFAULT_RETRY)
+                break
+            except Exception:
+                reason = (job.error_result or {}).get('reason')
+                if reason not in TRANSIENT_ERRORS or attempt == max_attempts:
+                    raise
+                backoff = min(MAX_BACKOFF_SECONDS, 2 ** attempt)
+                print('Job {} failed with {}, retrying in {} seconds ...'.format(job.job_id, reason, backoff))
+                time.sleep(backoff)
+        
+        tblname = '{}.{}'.format(job.ddl_target_table.dataset_id, job.ddl_target_table.table_id)
+        print('{} created in {}'.format(tblname, job.ended - job.started))
+        return tblname, {
+            'created_table': tblname,
+            'job_id': job.job_id,
+            'attempts': attempt,
+            'elapsed_seconds': (job.ended - job.started).total_seconds(),
+            'total_bytes_processed': job.total_bytes_processed,
+            'total_bytes_billed': job.total_bytes_billed,
+            'slot_millis': job.slot_millis,
+        }
+    
+    start_time = time.time()
+    with futures.ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        results = list(executor.map(run_job, queries))
+    wall_seconds = time.time() - start_time
+    
+    job_stats = [stats for _, stats in results]
+    print('{} jobs completed in {:.1f} seconds, {:.1f} seconds of job time'.format(
+        len(queries), wall_seconds, sum(stats['elapsed_seconds'] for stats in job_stats)))
+    
     from collections import namedtuple
-    result_tuple = namedtuple('DDLOutput', ['created_table', 'query'])
-    return result_tuple(tblname, query_string)
+    result_tuple = namedtuple('DDLJobsOutput', ['created_tables', 'stats'])
+    return result_tuple(
+        json.dumps([tblname for tblname, _ in results]),
+        json.dumps({'wall_seconds': wall_seconds, 'jobs': job_stats}))
 
 def train_matrix_factorization_model(ddlop, project_id: str, dataset: str):
     query = """
@@ -71,10 +153,13 @@ def evaluate_matrix_factorization_model(project_id:str, mf_model:str, location:s
     result_tuple = namedtuple('MFMetrics', ['msqe'])
     return result_tuple(metrics_df.loc[0].to_dict()['mean_squared_error'])
 
-def create_user_features(ddlop, project_id:str, dataset:str, mf_model:str):
+USER_FEATURES_TABLE = 'user_features_prod'
+HOTEL_FEATURES_TABLE = 'hotel_features_prod'
+
+def user_features_query(project_id:str, dataset:str, mf_model:str):
     #Feature engineering for useres
     query = """
-        CREATE OR REPLACE TABLE  `{project_id}.{dataset}.user_features_prod` AS
+        CREATE OR REPLACE TABLE  `{project_id}.{dataset}.{table}` AS
         WITH u as 
         (
             select
@@ -93,13 +178,16 @@ def create_user_features(ddlop, project_id:str, dataset:str, mf_model:str):
         FROM
             u JOIN ML.WEIGHTS( MODEL `{mf_model}`) w
             ON processed_input = 'user_id' AND feature = CAST(u.user_id AS STRING)
-    """.format(project_id = project_id, dataset = dataset, mf_model=mf_model)
-    return ddlop(project_id, query, 'US')
+    """.format(project_id = project_id, dataset = dataset, mf_model=mf_model, table=USER_FEATURES_TABLE)
+    return query
 
-def create_hotel_features(ddlop, project_id:str, dataset:str, mf_model:str):
+def create_user_features(ddlop, project_id:str, dataset:str, mf_model:str):
+    return ddlop(project_id, user_features_query(project_id, dataset, mf_model), 'US')
+
+def hotel_features_query(project_id:str, dataset:str, mf_model:str):
     #Feature eingineering for hotels
     query = """
-        CREATE OR REPLACE TABLE  `{project_id}.{dataset}.hotel_features_prod` AS
+        CREATE OR REPLACE TABLE  `{project_id}.{dataset}.{table}` AS
         WITH h as 
         (
             select
@@ -118,11 +206,124 @@ def create_hotel_features(ddlop, project_id:str, dataset:str, mf_model:str):
         FROM
             h JOIN ML.WEIGHTS( MODEL `{mf_model}`) w
             ON processed_input = 'hotel_cluster' AND feature = CAST(h.hotel_cluster AS STRING)
-    """.format(project_id = project_id, dataset = dataset, mf_model=mf_model)
-    return ddlop(project_id, query, 'US')
+    """.format(project_id = project_id, dataset = dataset, mf_model=mf_model, table=HOTEL_FEATURES_TABLE)
+    return query
+
+def create_hotel_features(ddlop, project_id:str, dataset:str, mf_model:str):
+    return ddlop(project_id, hotel_features_query(project_id, dataset, mf_model), 'US')
+
+def create_features(ddl_jobs_op, project_id:str, dataset:str, mf_model:str):
+    #User and hotel features are independent, so they are created concurrently
+    queries = [
+        user_features_query(project_id, dataset, mf_model),
+        hotel_features_query(project_id, dataset, mf_model),
+    ]
+    return ddl_jobs_op(project_id, json.dumps(queries), 'US')
+
+def generate_hotel_candidates(project_id:str, dataset:str, mf_model:str, user_features:str, hotel_features:str, num_candidates:int, location:str='US') -> NamedTuple(
+    'CandidatesOutput', [('created_table', str), ('stats', str)]):
+    """
+    Retrieves the top hotel clusters of each user with a ScaNN index over the hotel factors
+    
+    The index is built like in bqml-scann/index_builder, on the raw factors, as
+    the matrix factorization scores a user and hotel pair by their dot product
+    plus the user and hotel intercepts. The hotel intercept is indexed as an
+    extra dimension, matched by a constant 1 in the user queries, and the user
+    intercept is left out as it does not change the ranking of a user's hotels.
+    """
+    import json
+    import math
+    import time
+    import numpy as np
+    import pandas as pd
+    import scann
+    from google.cloud import bigquery
+    
+    METRIC = 'dot_product'
+    DIMENSIONS_PER_BLOCK = 2
+    ANISOTROPIC_QUANTIZATION_THRESHOLD = 0.2
+    NUM_LEAVES_TO_SEARCH = 200
+    REORDER_NUM_NEIGHBOURS = 200
+    QUERY_BATCH_SIZE = 10000
+    
+    bqclient = bigquery.Client(project=project_id, location=location)
+    hotels_query = """
+        SELECT h.hotel_cluster, h.hotel_factors, IFNULL(w.intercept, 0) AS hotel_intercept
+        FROM `{hotel_features}` h JOIN ML.WEIGHTS(MODEL `{project_id}.{mf_model}`) w
+        ON w.processed_input = 'hotel_cluster' AND w.feature = CAST(h.hotel_cluster AS STRING)
+    """.format(project_id = project_id, mf_model = mf_model, hotel_features = hotel_features)
+    hotels = bqclient.query(hotels_query).to_dataframe()
+    users = bqclient.query('SELECT user_id, user_factors FROM `{}`'.format(user_features)).to_dataframe()
+    hotel_factors = np.column_stack([
+        np.stack(hotels['hotel_factors'].values), hotels['hotel_intercept'].values]).astype(np.float32)
+    user_factors = np.column_stack([
+        np.stack(users['user_factors'].values), np.ones(len(users))]).astype(np.float32)
+    num_candidates = min(num_candidates, len(hotels))
+    print('Indexing {} hotel clusters for {} users'.format(len(hotels), len(users)))
+    
+    start_time = time.time()
+    num_leaves = int(math.sqrt(len(hotels)))
+    scann_builder = scann.scann_ops_pybind.builder(hotel_factors, num_candidates, METRIC)
+    scann_builder = scann_builder.tree(
+        num_leaves=num_leaves,
+        num_leaves_to_search=min(NUM_LEAVES_TO_SEARCH, num_leaves),
+        training_sample_size=len(hotels))
+    scann_builder = scann_builder.score_ah(
+        DIMENSIONS_PER_BLOCK,
+        anisotropic_quantization_threshold=ANISOTROPIC_QUANTIZATION_THRESHOLD)
+    scann_builder = scann_builder.reorder(min(max(REORDER_NUM_NEIGHBOURS, num_candidates), len(hotels)))
+    scann_index = scann_builder.build()
+    build_seconds = time.time() - start_time
+    
+    start_time = time.time()
+    match_indices = []
+    match_scores = []
+    for start in range(0, len(users), QUERY_BATCH_SIZE):
+        indices, scores = scann_index.search_batched(
+            user_factors[start: start + QUERY_BATCH_SIZE], final_num_neighbors=num_candidates)
+        match_indices.append(indices)
+        match_scores.append(scores)
+    match_indices = np.concatenate(match_indices)
+    search_seconds = time.time() - start_time
+    
+    candidates = pd.DataFrame({
+        'user_id': np.repeat(users['user_id'].values, num_candidates),
+        'hotel_cluster': hotels['hotel_cluster'].values[match_indices.ravel()],
+        'candidate_score': np.concatenate(match_scores).ravel(),
+    })
+    tblname = '{}.user_hotel_candidates_prod'.format(dataset)
+    job_config = bigquery.LoadJobConfig(write_disposition='WRITE_TRUNCATE')
+    bqclient.load_table_from_dataframe(
+        candidates, '{}.{}'.format(project_id, tblname), job_config=job_config).result()
+    
+    stats = {
+        'num_users': len(users),
+        'num_hotels': len(hotels),
+        'num_candidates': len(candidates),
+        'cross_join_size': len(users) * len(hotels),
+        'build_seconds': build_seconds,
+        'search_seconds': search_seconds,
+    }
+    print('{} created with {} candidates instead of {} pairs'.format(
+        tblname, stats['num_candidates'], stats['cross_join_size']))
+    
+    from collections import namedtuple
+    result_tuple = namedtuple('CandidatesOutput', ['created_table', 'stats'])
+    return result_tuple(tblname, json.dumps(stats))
 
-def combine_features(ddlop, project_id:str, dataset:str, mf_model:str, hotel_features:str, user_features:str):
+def combine_features(ddlop, project_id:str, dataset:str, mf_model:str, hotel_features:str, user_features:str, candidates:str=None):
     #Combine user and hotel embedding features with the rating associated with each combination
+    #With candidates, only the retrieved hotel clusters and the rated ones are kept for each user, instead of all of them
+    if candidates:
+        pairs = """
+        SELECT user_id, hotel_cluster FROM `{candidates}`
+        UNION DISTINCT
+        SELECT user_id, hotel_cluster FROM ratings
+        """.format(candidates=candidates)
+    else:
+        pairs = """
+        SELECT user_id, hotel_cluster FROM `{user_features}`, `{hotel_features}`
+        """.format(hotel_features=hotel_features, user_features=user_features)
     query = """
         CREATE OR REPLACE TABLE `{project_id}.{dataset}.total_features_prod` AS
         with ratings as(
@@ -132,15 +333,18 @@ def combine_features(ddlop, project_id:str, dataset:str, mf_model:str, hotel_fea
             if(sum(is_booking) > 0, 1, sum(is_booking)) AS rating
           FROM `{project_id}.{dataset}.hotel_train`
           group by 1,2
-        )
+        ),
+        pairs as({pairs})
         select
           h.* EXCEPT(hotel_cluster),
           u.* EXCEPT(user_id),
           IFNULL(rating,0) as rating
-        from `{hotel_features}` h, `{user_features}` u
+        from pairs p
+        JOIN `{hotel_features}` h ON h.hotel_cluster = p.hotel_cluster
+        JOIN `{user_features}` u ON u.user_id = p.user_id
         LEFT OUTER JOIN ratings r
-        ON r.user_id = u.user_id AND r.hotel_cluster = h.hotel_cluster
-    """.format(project_id = project_id, dataset = dataset, mf_model=mf_model, hotel_features=hotel_features, user_features=user_features)
+        ON r.user_id = p.user_id AND r.hotel_cluster = p.hotel_cluster
+    """.format(project_id = project_id, dataset = dataset, mf_model=mf_model, hotel_features=hotel_features, user_features=user_features, pairs=pairs)
     return ddlop(project_id, query, 'US')
 
 def train_xgboost_model(ddlop, project_id:str, dataset:str, total_features:str):
@@ -184,6 +388,132 @@ def evaluate_class(project_id:str, dataset:str, class_model:str, total_features:
     result_tuple = namedtuple('ClassMetrics', ['roc_auc'])
     return result_tuple(metrics_df.loc[0].to_dict()['roc_auc'])
 
+def evaluate_matrix_factorization_model_sampled(project_id:str, dataset:str, mf_model:str, sample_size:int=100000, location:str='US')-> NamedTuple('MFMetrics', [('msqe', float), ('msqe_lower', float), ('msqe_upper', float)]):
+    """
+    Estimates the MSE of the matrix factorization model on a stratified sample of the ratings
+    
+    The factors are read once with ML.WEIGHTS and the sample is scored locally.
+    Each rating class is sampled with up to sample_size / 2 rows, and the rows are
+    weighted by their inverse sampling rate so that the MSE is unbiased.
+    """
+    import numpy as np
+    from google.cloud import bigquery
+    
+    Z = 1.96
+    bqclient = bigquery.Client(project=project_id, location=location)
+    
+    weights_query = """
+        SELECT
+          processed_input,
+          feature,
+          ARRAY(SELECT weight FROM UNNEST(factor_weights) ORDER BY factor) AS factors,
+          IFNULL(intercept, 0) AS intercept
+        FROM ML.WEIGHTS(MODEL `{project_id}.{mf_model}`)
+    """.format(project_id = project_id, mf_model = mf_model)
+    sample_query = """
+        WITH ratings AS (
+          SELECT
+            user_id,
+            hotel_cluster,
+            if(sum(is_booking) > 0, 1, sum(is_booking)) AS rating
+          FROM `{project_id}.{dataset}.hotel_train`
+          group by 1,2
+        ),
+        sampling_rates AS (
+          SELECT rating, LEAST(1, {per_class} / COUNT(*)) AS sampling_rate
+          FROM ratings
+          GROUP BY rating
+        )
+        SELECT user_id, hotel_cluster, rating, sampling_rate
+        FROM ratings JOIN sampling_rates USING (rating)
+        WHERE RAND() < sampling_rate
+    """.format(project_id = project_id, dataset = dataset, per_class = sample_size // 2)
+    print(sample_query)
+    
+    # Stream the results in columnar form with the BigQuery Storage API.
+    weights = bqclient.query(weights_query).result().to_dataframe(create_bqstorage_client=True)
+    sample = bqclient.query(sample_query).result().to_dataframe(create_bqstorage_client=True)
+    print('{} ratings are sampled'.format(len(sample)))
+    
+    users = weights[weights.processed_input == 'user_id'].set_index('feature')
+    hotels = weights[weights.processed_input == 'hotel_cluster'].set_index('feature')
+    user_rows = users.loc[sample.user_id.astype(str)]
+    hotel_rows = hotels.loc[sample.hotel_cluster.astype(str)]
+    predictions = (
+        np.einsum('ij,ij->i', np.stack(user_rows.factors.values), np.stack(hotel_rows.factors.values))
+        + user_rows.intercept.values + hotel_rows.intercept.values)
+    
+    squared_errors = (sample.rating.values - predictions) ** 2
+    sample_weights = 1 / sample.sampling_rate.values
+    msqe = np.sum(sample_weights * squared_errors) / np.sum(sample_weights)
+    stderr = np.sqrt(np.sum((sample_weights * (squared_errors - msqe)) ** 2)) / np.sum(sample_weights)
+    print('MSE: {} [{}, {}]'.format(msqe, msqe - Z * stderr, msqe + Z * stderr))
+    
+    from collections import namedtuple
+    result_tuple = namedtuple('MFMetrics', ['msqe', 'msqe_lower', 'msqe_upper'])
+    return result_tuple(float(msqe), float(msqe - Z * stderr), float(msqe + Z * stderr))
+
+def evaluate_class_sampled(project_id:str, dataset:str, model_dir:str, total_features:str, sample_size:int=100000, location:str='US')-> NamedTuple('ClassMetrics', [('roc_auc', float), ('roc_auc_lower', float), ('roc_auc_upper', float)]):
+    """
+    Estimates the ROC-AUC of the exported XGBoost booster on a stratified sample of the features
+    """
+    import json
+    import gcsfs
+    import numpy as np
+    import pandas as pd
+    import xgboost as xgb
+    from google.cloud import bigquery
+    
+    Z = 1.96
+    
+    def roc_auc_with_ci(labels, scores):
+        #DeLong confidence interval, computed with ranks. Stratified sampling of the classes does not bias the ROC-AUC,
+        #which only depends on the score distribution within each class
+        labels = np.asarray(labels).astype(bool)
+        positives, negatives = scores[labels], scores[~labels]
+        ranks = pd.Series(scores).rank().values
+        #Fraction of negatives scored below each positive, and of positives scored above each negative, ties counted half
+        positive_placements = (ranks[labels] - pd.Series(positives).rank().values) / len(negatives)
+        negative_placements = 1 - (ranks[~labels] - pd.Series(negatives).rank().values) / len(positives)
+        roc_auc = positive_placements.mean()
+        stderr = np.sqrt(positive_placements.var(ddof=1) / len(positives) + negative_placements.var(ddof=1) / len(negatives))
+        return float(roc_auc), float(roc_auc - Z * stderr), float(roc_auc + Z * stderr)
+    
+    query = """
+        WITH sampling_rates AS (
+          SELECT rating, LEAST(1, {per_class} / COUNT(*)) AS sampling_rate
+          FROM `{total_features}`
+          GROUP BY rating
+        )
+        SELECT
+          * EXCEPT(user_factors, hotel_factors, sampling_rate),
+            {dataset}.arr_to_input_15_users(user_factors).*,
+            {dataset}.arr_to_input_15_hotels(hotel_factors).*
+        FROM
+          `{total_features}` JOIN sampling_rates USING (rating)
+        WHERE RAND() < sampling_rate
+    """.format(dataset = dataset, total_features = total_features, per_class = sample_size // 2)
+    print(query)
+    
+    bqclient = bigquery.Client(project=project_id, location=location)
+    # Stream the results in columnar form with the BigQuery Storage API.
+    sample = bqclient.query(query).result().to_dataframe(create_bqstorage_client=True)
+    print('{} rows are sampled'.format(len(sample)))
+    
+    fs = gcsfs.GCSFileSystem(project=project_id)
+    with fs.open('{}/model.bst'.format(model_dir), 'rb') as handle:
+        booster = xgb.Booster(model_file=bytearray(handle.read()))
+    with fs.open('{}/assets/model_metadata.json'.format(model_dir), 'r') as handle:
+        feature_names = json.load(handle)['feature_names']
+    
+    inputs = xgb.DMatrix(sample[feature_names].values.astype(np.float32), feature_names=feature_names)
+    roc_auc, roc_auc_lower, roc_auc_upper = roc_auc_with_ci(sample.rating.values, booster.predict(inputs))
+    print('ROC-AUC: {} [{}, {}]'.format(roc_auc, roc_auc_lower, roc_auc_upper))
+    
+    from collections import namedtuple
+    result_tuple = namedtuple('ClassMetrics', ['roc_auc', 'roc_auc_lower', 'roc_auc_upper'])
+    return result_tuple(roc_auc, roc_auc_lower, roc_auc_upper)
+
 def export_bqml_model(project_id:str, model:str, destination:str) -> NamedTuple('ModelExport', [('destination', str)]):
     import subprocess
     #command='bq extract -destination_format=ML_XGBOOST_BOOSTER -m {}:{} {}'.format(project_id, model, destination)
@@ -215,11 +545,22 @@ def training_pipeline(project_id:str, dataset_name:str, model_storage:str, base_
     mf_msqe_threshold = 0.5
     class_auc_threshold = 0.8
     
+    #Number of hotel clusters retrieved for each user to train and evaluate the XGBoost model on
+    num_candidates = 20
+    
+    #Evaluate the models locally on a stratified sample instead of with ML.EVALUATE over the full tables
+    sampled_evaluation = True
+    evaluation_sample_size = 100000
+    
     #Defining function containers
     ddlop = comp.func_to_container_op(run_bigquery_ddl, packages_to_install=['google-cloud-bigquery'])
+    ddl_jobs_op = comp.func_to_container_op(run_bigquery_ddl_jobs, packages_to_install=['google-cloud-bigquery'])
     evaluate_mf_op = comp.func_to_container_op(evaluate_matrix_factorization_model, base_image=base_image, packages_to_install=['google-cloud-bigquery','pandas'])
     evaluate_class_op = comp.func_to_container_op(evaluate_class, base_image=base_image, packages_to_install=['google-cloud-bigquery','pandas'])
+    evaluate_mf_sampled_op = comp.func_to_container_op(evaluate_matrix_factorization_model_sampled, base_image=base_image, packages_to_install=['google-cloud-bigquery[bqstorage,pandas]','pyarrow'])
+    evaluate_class_sampled_op = comp.func_to_container_op(evaluate_class_sampled, base_image=base_image, packages_to_install=['google-cloud-bigquery[bqstorage,pandas]','pyarrow','gcsfs','xgboost'])
     export_bqml_model_op = comp.func_to_container_op(export_bqml_model, base_image=base_image, packages_to_install=['google-cloud-bigquery'])
+    generate_candidates_op = comp.func_to_container_op(generate_hotel_candidates, base_image=base_image, packages_to_install=['google-cloud-bigquery[pandas]','pyarrow','scann==1.1.1'])
     
     #Train matrix factorization model
     mf_model_output = train_matrix_factorization_model(ddlop, project_id, dataset).set_display_name('train matrix factorization model')
@@ -227,22 +568,28 @@ def training_pipeline(project_id:str, dataset_name:str, model_storage:str, base_
     mf_model = mf_model_output.outputs['created_table']
     
     #Evaluate matrix factorization model
-    mf_eval_output = evaluate_mf_op(project_id, mf_model).set_display_name('evaluate matrix factorization model')
+    if sampled_evaluation:
+        mf_eval_output = evaluate_mf_sampled_op(project_id, dataset, mf_model, evaluation_sample_size).set_display_name('evaluate matrix factorization model')
+    else:
+        mf_eval_output = evaluate_mf_op(project_id, mf_model).set_display_name('evaluate matrix factorization model')
     mf_eval_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
     
     #mean squared quantization error 
     with dsl.Condition(mf_eval_output.outputs['msqe'] < mf_msqe_threshold):
     
         #Create features for Classification model
-        user_features_output = create_user_features(ddlop, project_id, dataset, mf_model).set_display_name('create user factors features')
-        user_features = user_features_output.outputs['created_table']
-        user_features_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
-        
-        hotel_features_output = create_hotel_features(ddlop, project_id, dataset, mf_model).set_display_name('create hotel factors features')
-        hotel_features = hotel_features_output.outputs['created_table']
-        hotel_features_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
+        features_output = create_features(ddl_jobs_op, project_id, dataset, mf_model).set_display_name('create user and hotel factors features')
+        features_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
+        user_features = '{}.{}'.format(dataset, USER_FEATURES_TABLE)
+        hotel_features = '{}.{}'.format(dataset, HOTEL_FEATURES_TABLE)
+
+        #Retrieve the candidate hotel clusters of each user, instead of pairing each user with all the hotel clusters
+        candidates_output = generate_candidates_op(project_id, dataset, mf_model, user_features, hotel_features, num_candidates).set_display_name('generate hotel candidates')
+        candidates_output.after(features_output)
+        candidates_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
+        candidates = candidates_output.outputs['created_table']
 
-        total_features_output = combine_features(ddlop, project_id, dataset, mf_model, hotel_features, user_features).set_display_name('combine all features')
+        total_features_output = combine_features(ddlop, project_id, dataset, mf_model, hotel_features, user_features, candidates).set_display_name('combine all features')
         total_features = total_features_output.outputs['created_table']
         total_features_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
 
@@ -254,7 +601,15 @@ def training_pipeline(project_id:str, dataset_name:str, model_storage:str, base_
         class_model = 'hotel_recommendations.recommender_hybrid_xgboost_prod'
     
         #Evaluate XGBoost model
-        class_eval_output = evaluate_class_op(project_id, dataset, class_model, total_features).set_display_name('evaluate XGBoost model')
+        if sampled_evaluation:
+            #Export the candidate model to score it locally
+            candidate_export_output = export_bqml_model_op(project_id, class_model, '{}/candidate'.format(model_storage)).set_display_name('export candidate XGBoost model')
+            candidate_export_output.after(class_model_output)
+            candidate_export_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
+            candidate_model_dir = candidate_export_output.outputs['destination']
+            class_eval_output = evaluate_class_sampled_op(project_id, dataset, candidate_model_dir, total_features, evaluation_sample_size).set_display_name('evaluate XGBoost model')
+        else:
+            class_eval_output = evaluate_class_op(project_id, dataset, class_model, total_features).set_display_name('evaluate XGBoost model')
         class_eval_output.execution_options.caching_strategy.max_cache_staleness = 'P0D'
         
         with dsl.Condition(class_eval_output.outputs['roc_auc'] > class_auc_threshold):
@@ -0,0 +1,90 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import numpy as np
+from flask import Flask
+from flask import request
+from flask import jsonify
+
+from scoring import XGBoostScorer, load_feature_tables
+
+PROJECT_ID = os.environ['PROJECT_ID']
+BQ_DATASET_NAME = os.environ['BQ_DATASET_NAME']
+MODEL_DIR = os.environ['MODEL_DIR']
+FEATURES_CACHE_DIR = os.environ.get('FEATURES_CACHE_DIR', os.path.join(MODEL_DIR, 'features'))
+PORT = os.environ['PORT']
+
+
+user_features, hotel_features = load_feature_tables(
+    PROJECT_ID, BQ_DATASET_NAME, FEATURES_CACHE_DIR)
+scorer = XGBoostScorer(MODEL_DIR, user_features, hotel_features)
+
+app = Flask(__name__)
+
+
+@app.route("/v1/models/<model>/versions/<version>", methods=["GET"])
+def health(model, version):
+  return jsonify({})
+
+
+@app.route("/v1/models/<model>/versions/<version>:predict", methods=["POST"])
+def predict(model, version):
+  result = 'predictions'
+  try:
+    instances = request.get_json()['instances']
+    is_valid, error = validate_request(instances)
+
+    if not is_valid:
+      value = error
+    else:
+      # Score the candidates of all the instances in a single batch.
+      sizes = [len(instance['hotel_clusters']) for instance in instances]
+      user_ids = np.repeat([instance['user_id'] for instance in instances], sizes)
+      hotel_clusters = np.concatenate(
+        [np.asarray(instance['hotel_clusters'], dtype=np.int64) for instance in instances])
+      scores = scorer.score(user_ids, hotel_clusters)
+
+      value = []
+      for instance, start, end in zip(instances, np.cumsum([0] + sizes), np.cumsum(sizes)):
+        order = np.argsort(-scores[start:end], kind='stable')[:instance.get('top_k')]
+        value.append({
+          'hotel_clusters': hotel_clusters[start:end][order].tolist(),
+          'scores': scores[start:end][order].tolist(),
+        })
+
+  except Exception as error:
+    value = 'Unexpected error: {}'.format(error)
+    result = 'error'
+
+  response = jsonify({result: value})
+  return response
+
+
+def validate_request(instances):
+  is_valid = True
+  error = ''
+
+  if not instances:
+    is_valid = False
+    error = 'You need to provide at least one instance!'
+  elif any('user_id' not in instance or not instance.get('hotel_clusters') for instance in instances):
+    is_valid = False
+    error = 'You need to provide the user_id and the candidate hotel_clusters of each instance!'
+
+  return is_valid, error
+
+
+if __name__ == '__main__':
+  app.run(host='0.0.0.0', port=PORT)
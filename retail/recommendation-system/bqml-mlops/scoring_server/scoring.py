@@ -0,0 +1,153 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import io
+import json
+import numpy as np
+import xgboost as xgb
+import tensorflow as tf
+
+MODEL_FILE_NAME = 'model.bst'
+MODEL_METADATA_FILE_PATH = 'assets/model_metadata.json'
+NUM_FACTORS = 15
+
+# The feature tables, their key and factors columns, and the prefix of the
+# expanded factor features, as in arr_to_input_15_users/arr_to_input_15_hotels.
+USER_FEATURES = ('user_features_prod', 'user_id', 'user_factors', 'u')
+HOTEL_FEATURES = ('hotel_features_prod', 'hotel_cluster', 'hotel_factors', 'h')
+
+
+class FeatureTable(object):
+  """In-memory feature table, with the rows sorted by key for vectorized lookups."""
+
+  def __init__(self, keys, columns, values):
+    order = np.argsort(keys)
+    self.keys = np.asarray(keys, dtype=np.int64)[order]
+    self.columns = list(columns)
+    self.values = np.asarray(values, dtype=np.float32)[order]
+
+  def lookup(self, keys):
+    """Returns the row index of each key, and whether the key exists."""
+    keys = np.asarray(keys, dtype=np.int64)
+    rows = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+    return rows, self.keys[rows] == keys
+
+  def save(self, file_path):
+    buffer = io.BytesIO()
+    np.savez(buffer, keys=self.keys, columns=np.array(self.columns), values=self.values)
+    with tf.io.gfile.GFile(file_path, 'wb') as handle:
+      handle.write(buffer.getvalue())
+
+  @classmethod
+  def load(cls, file_path):
+    with tf.io.gfile.GFile(file_path, 'rb') as handle:
+      table = np.load(io.BytesIO(handle.read()))
+      return cls(table['keys'], table['columns'].tolist(), table['values'])
+
+
+def load_feature_table(project_id, dataset, table_name, key_column, factors_column, factors_prefix):
+  """Reads a feature table from BigQuery and expands its factors array."""
+  from google.cloud import bigquery
+
+  print(f'Loading {dataset}.{table_name} from BigQuery...')
+  client = bigquery.Client(project=project_id)
+  dataframe = client.query(f'SELECT * FROM `{project_id}.{dataset}.{table_name}`').to_dataframe()
+  factors = np.stack(dataframe[factors_column].values)[:, :NUM_FACTORS]
+  stats = dataframe.drop(columns=[key_column, factors_column])
+  columns = list(stats.columns) + [f'{factors_prefix}{idx + 1}' for idx in range(NUM_FACTORS)]
+  values = np.concatenate([stats.values.astype(np.float32), factors.astype(np.float32)], axis=1)
+  print(f'{len(dataframe)} rows are loaded.')
+  return FeatureTable(dataframe[key_column].values, columns, values)
+
+
+def load_feature_tables(project_id, dataset, cache_dir):
+  """Loads the user and hotel feature tables, from the cache if it exists."""
+  tables = []
+  for table_name, key_column, factors_column, factors_prefix in [USER_FEATURES, HOTEL_FEATURES]:
+    cache_file_path = os.path.join(cache_dir, f'{table_name}.npz')
+    if tf.io.gfile.exists(cache_file_path):
+      print(f'Loading {table_name} from {cache_file_path}...')
+      table = FeatureTable.load(cache_file_path)
+    else:
+      table = load_feature_table(
+        project_id, dataset, table_name, key_column, factors_column, factors_prefix)
+      tf.io.gfile.makedirs(cache_dir)
+      table.save(cache_file_path)
+      print(f'{table_name} is cached to {cache_file_path}.')
+    tables.append(table)
+  return tables
+
+
+class XGBoostScorer(object):
+  """Scores user and hotel cluster pairs with the exported BQML booster."""
+
+  def __init__(self, model_dir, user_features, hotel_features):
+    print('Loading XGBoost booster...')
+    with tf.io.gfile.GFile(os.path.join(model_dir, MODEL_FILE_NAME), 'rb') as handle:
+      self.booster = xgb.Booster(model_file=bytearray(handle.read()))
+    with tf.io.gfile.GFile(os.path.join(model_dir, MODEL_METADATA_FILE_PATH), 'r') as handle:
+      self.feature_names = json.load(handle)['feature_names']
+    print(f'Booster with {len(self.feature_names)} features is loaded.')
+
+    self.user_features = user_features
+    self.hotel_features = hotel_features
+
+    # Map each model feature to its column in the user or hotel table once, so
+    # that the model input is assembled with two fancy-indexing copies.
+    user_columns = {name: idx for idx, name in enumerate(user_features.columns)}
+    hotel_columns = {name: idx for idx, name in enumerate(hotel_features.columns)}
+    missing = [
+      name for name in self.feature_names
+      if name not in user_columns and name not in hotel_columns]
+    if missing:
+      raise ValueError(f'Features {missing} are not in the user or hotel feature tables.')
+    self.user_positions = np.array(
+      [pos for pos, name in enumerate(self.feature_names) if name in user_columns], dtype=np.int64)
+    self.user_columns = np.array(
+      [user_columns[name] for name in self.feature_names if name in user_columns], dtype=np.int64)
+    self.hotel_positions = np.array(
+      [pos for pos, name in enumerate(self.feature_names) if name not in user_columns], dtype=np.int64)
+    self.hotel_columns = np.array(
+      [hotel_columns[name] for name in self.feature_names if name not in user_columns], dtype=np.int64)
+
+  def assemble(self, user_ids, hotel_clusters):
+    """Builds the model input for aligned user Ids and hotel clusters.
+
+    Unknown users or hotel clusters get missing (NaN) features.
+    """
+    user_rows, user_found = self.user_features.lookup(user_ids)
+    hotel_rows, hotel_found = self.hotel_features.lookup(hotel_clusters)
+
+    inputs = np.empty((len(user_rows), len(self.feature_names)), dtype=np.float32)
+    inputs[:, self.user_positions] = self.user_features.values[
+      user_rows[:, np.newaxis], self.user_columns]
+    inputs[:, self.hotel_positions] = self.hotel_features.values[
+      hotel_rows[:, np.newaxis], self.hotel_columns]
+    inputs[np.ix_(~user_found, self.user_positions)] = np.nan
+    inputs[np.ix_(~hotel_found, self.hotel_positions)] = np.nan
+    return inputs
+
+  def score(self, user_ids, hotel_clusters):
+    """Returns the booking probability of each user and hotel cluster pair."""
+    inputs = self.assemble(user_ids, hotel_clusters)
+    matrix = xgb.DMatrix(inputs, missing=np.nan, feature_names=self.feature_names)
+    return self.booster.predict(matrix)
+
+  def rank(self, user_id, hotel_clusters, top_k=None):
+    """Returns the candidate hotel clusters of a user, ordered by score."""
+    hotel_clusters = np.asarray(hotel_clusters, dtype=np.int64)
+    scores = self.score(np.full(len(hotel_clusters), user_id), hotel_clusters)
+    order = np.argsort(-scores, kind='stable')[:top_k]
+    return hotel_clusters[order], scores[order]
@@ -13,15 +13,44 @@
 # limitations under the License.
 
 
+import os
 import tensorflow as tf
 import numpy as np
 
 VOCABULARY_FILE_NAME = 'vocabulary.txt'
+EMBEDDING_DTYPES = ['float32', 'float16', 'int8']
+INT8_MAX = 127.
+
+
+def compress_embeddings(embeddings, embedding_dtype):
+  """Converts float32 embeddings to the storage dtype.
+
+  For int8, each row is quantized symmetrically and its float32 scale is
+  returned alongside; otherwise the returned scales are None.
+  """
+  if embedding_dtype not in EMBEDDING_DTYPES:
+    raise ValueError(f'Unsupported embedding dtype: {embedding_dtype}. Supported dtypes: {EMBEDDING_DTYPES}')
+  
+  if embedding_dtype != 'int8':
+    return embeddings.astype(embedding_dtype), None
+  
+  scales = np.max(np.abs(embeddings), axis=1) / INT8_MAX
+  scales[scales == 0] = 1.
+  quantized = np.round(embeddings / scales[:, np.newaxis]).astype(np.int8)
+  return quantized, scales.astype(np.float32)
+
+
+def get_dir_size(dir_path):
+  size = 0
+  for dir_name, _, file_names in tf.io.gfile.walk(dir_path):
+    for file_name in file_names:
+      size += tf.io.gfile.stat(os.path.join(dir_name, file_name)).length
+  return size
 
 
 class EmbeddingLookup(tf.keras.Model):
 
-  def __init__(self, embedding_files_prefix, **kwargs):
+  def __init__(self, embedding_files_prefix, vocabulary_dir, embedding_dtype='float32', **kwargs):
     super(EmbeddingLookup, self).__init__(**kwargs)
 
     vocabulary = list()
@@ -43,20 +72,30 @@ class EmbeddingLookup(tf.keras.Model):
     print('Embeddings loaded.')
     
     embedding_size = len(embeddings[0])
-    oov_embedding = np.zeros((1, embedding_size))
-    self.embeddings = np.append(np.array(embeddings), oov_embedding, axis=0)
-    print(f'Embeddings: {self.embeddings.shape}')
+    oov_embedding = np.zeros((1, embedding_size), dtype=np.float32)
+    embeddings = np.append(np.array(embeddings, dtype=np.float32), oov_embedding, axis=0)
+    self.embeddings, self.scales = compress_embeddings(embeddings, embedding_dtype)
+    print(f'Embeddings: {self.embeddings.shape} stored as {self.embeddings.dtype} '
+      f'({self.embeddings.nbytes} bytes, {embeddings.size * 8} bytes as float64).')
 
     # Write vocabulary file.
     print('Writing vocabulary to file...')
-    with open(VOCABULARY_FILE_NAME, 'w') as f:
+    tf.io.gfile.makedirs(vocabulary_dir)
+    vocabulary_file_path = os.path.join(vocabulary_dir, VOCABULARY_FILE_NAME)
+    with tf.io.gfile.GFile(vocabulary_file_path, 'w') as f:
       for item in vocabulary: 
         f.write(f'{item}\n')
     print('Vocabulary file written and will be added as a model asset.')
 
-    self.vocabulary_file = tf.saved_model.Asset(VOCABULARY_FILE_NAME)
-    initializer = tf.lookup.KeyValueTensorInitializer(
-        keys=vocabulary, values=list(range(len(vocabulary))))
+    # Initialize the table from the vocabulary asset, so that the item Ids are
+    # not embedded in the graph as constants.
+    self.vocabulary_file = tf.saved_model.Asset(vocabulary_file_path)
+    initializer = tf.lookup.TextFileInitializer(
+        self.vocabulary_file, 
+        key_dtype=tf.string, 
+        key_index=tf.lookup.TextFileIndex.WHOLE_LINE,
+        value_dtype=tf.int64, 
+        value_index=tf.lookup.TextFileIndex.LINE_NUMBER)
     self.token_to_id = tf.lookup.StaticHashTable(
         initializer, default_value=len(vocabulary))
 
@@ -64,19 +103,23 @@ class EmbeddingLookup(tf.keras.Model):
   def __call__(self, inputs):
     tokens = tf.strings.split(inputs, sep=None).to_sparse()
     ids = self.token_to_id.lookup(tokens) 
-    embeddings = tf.nn.embedding_lookup_sparse(
-        params=self.embeddings, 
-        sp_ids=ids, 
-        sp_weights=None, 
-        combiner="mean"
+    # Combine in float32, whatever precision the embeddings are stored in.
+    vectors = tf.cast(tf.gather(self.embeddings, ids.values), tf.float32)
+    if self.scales is not None:
+      vectors = vectors * tf.expand_dims(tf.gather(self.scales, ids.values), 1)
+    embeddings = tf.math.unsorted_segment_mean(
+        vectors, 
+        segment_ids=ids.indices[:, 0], 
+        num_segments=tf.shape(inputs, out_type=tf.int64)[0]
     )
     return embeddings
 
 
 
-def export_saved_model(embedding_files_path, model_output_dir):
+def export_saved_model(embedding_files_path, model_output_dir, embedding_dtype='float32'):
   print('Instantiating embedding lookup model...')
-  embedding_lookup_model = EmbeddingLookup(embedding_files_path)
+  embedding_lookup_model = EmbeddingLookup(
+    embedding_files_path, model_output_dir, embedding_dtype)
   print('Model is Instantiated.')
   
   signatures = {
@@ -85,4 +128,12 @@ def export_saved_model(embedding_files_path, model_output_dir):
 
   print('Exporting embedding lookup model as a SavedModel...')
   tf.saved_model.save(embedding_lookup_model, model_output_dir, signatures=signatures)
-  print('SavedModel is exported.')
\ No newline at end of file
+  print('SavedModel is exported.')
+  # The vocabulary is now copied to the SavedModel assets.
+  tf.io.gfile.remove(os.path.join(model_output_dir, VOCABULARY_FILE_NAME))
+  
+  model_size = get_dir_size(model_output_dir)
+  float64_size = (model_size - embedding_lookup_model.embeddings.nbytes 
+                  + embedding_lookup_model.embeddings.size * 8)
+  print(f'SavedModel size: {model_size} bytes with {embedding_dtype} embeddings, '
+        f'about {float64_size} bytes with float64 embeddings.')
\ No newline at end of file
@@ -13,10 +13,12 @@
 # limitations under the License.
 
 import os
+import io
 import scann
 import tensorflow as tf
 import numpy as np
 import math
+import json
 import pickle
 
 METRIC = 'dot_product'
@@ -26,6 +28,8 @@ NUM_NEIGHBOURS = 10
 NUM_LEAVES_TO_SEARCH = 200
 REORDER_NUM_NEIGHBOURS = 200
 TOKENS_FILE_NAME = 'tokens'
+EMBEDDINGS_FILE_NAME = 'embeddings.npy'
+SEARCH_CONFIG_FILE_NAME = 'search_config.json'
 
 
 def load_embeddings(embedding_files_pattern):
@@ -75,7 +79,7 @@ def build_index(embeddings, num_leaves):
   return scann_index
 
 
-def save_index(index, tokens, output_dir):
+def save_index(index, tokens, embeddings, output_dir):
   print('Saving index as a SavedModel...')
   module = index.serialize_to_module()
   tf.saved_model.save(
@@ -88,13 +92,30 @@ def save_index(index, tokens, output_dir):
   with tf.io.gfile.GFile(tokens_file_path, 'wb') as handle:
     pickle.dump(tokens, handle, protocol=pickle.HIGHEST_PROTOCOL)
   print(f'Item file is saved to {tokens_file_path}.')
+
+  # The index server can match small catalogs exactly with the embeddings.
+  print('Saving embeddings file...')
+  embeddings_file_path = os.path.join(output_dir, EMBEDDINGS_FILE_NAME)
+  buffer = io.BytesIO()
+  np.save(buffer, np.asarray(embeddings, dtype=np.float32))
+  with tf.io.gfile.GFile(embeddings_file_path, 'wb') as handle:
+    handle.write(buffer.getvalue())
+  print(f'Embeddings file is saved to {embeddings_file_path}.')
  
 
 def build(embedding_files_pattern, output_dir, num_leaves=None):
   print("Indexer started...")
   tokens, embeddings = load_embeddings(embedding_files_pattern)
   index = build_index(embeddings, num_leaves)
-  save_index(index, tokens, output_dir)
+  save_index(index, tokens, embeddings, output_dir)
+
+  # The index server scales the default search effort down under load.
+  with tf.io.gfile.GFile(os.path.join(output_dir, SEARCH_CONFIG_FILE_NAME), 'w') as handle:
+    handle.write(json.dumps({
+      'num_leaves': num_leaves or int(math.sqrt(embeddings.shape[0])),
+      'num_leaves_to_search': NUM_LEAVES_TO_SEARCH,
+      'reorder_num_neighbours': REORDER_NUM_NEIGHBOURS,
+    }))
   print("Indexer finished.")
     
     
@@ -0,0 +1,92 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import time
+import threading
+import contextlib
+
+SERVICE_TIME_SMOOTHING = 0.1
+
+
+class RequestRejected(Exception):
+  """Raised when a request is not admitted, or is shed before it completes."""
+
+
+class AdmissionController(object):
+  """Bounds the requests that are served and queued, and enforces their deadlines.
+
+  At most max_concurrent_requests are served at the same time, and at most
+  max_queued_requests wait for their turn. A request is rejected on arrival
+  when the queue is full, or when its deadline is before the time it would
+  take to drain the queue ahead of it and serve it, estimated from the moving
+  average of the service time. A queued request is shed as soon as its
+  deadline passes.
+  """
+
+  def __init__(self, max_concurrent_requests, max_queued_requests):
+    self.max_concurrent_requests = max_concurrent_requests
+    self.max_queued_requests = max_queued_requests
+    self.semaphore = threading.BoundedSemaphore(max_concurrent_requests)
+    self.lock = threading.Lock()
+    self.num_queued = 0
+    self.service_time = None
+
+  def _estimate_completion_time(self):
+    if self.service_time is None:
+      return 0.
+    # The requests are served in rounds of max_concurrent_requests, and this
+    # one is in the round after the requests queued ahead of it.
+    rounds = math.ceil((self.num_queued + 1) / self.max_concurrent_requests)
+    return rounds * self.service_time
+
+  @contextlib.contextmanager
+  def admit(self, deadline):
+    """Serves the request within the context, or raises RequestRejected.
+
+    Args:
+      deadline: The time.monotonic() time by which the response is due.
+    """
+    with self.lock:
+      if self.num_queued >= self.max_queued_requests:
+        raise RequestRejected(f'The server is overloaded, {self.num_queued} requests are queued.')
+      if time.monotonic() + self._estimate_completion_time() > deadline:
+        raise RequestRejected('The request cannot complete before its deadline.')
+      self.num_queued += 1
+
+    try:
+      acquired = self.semaphore.acquire(timeout=max(0., deadline - time.monotonic()))
+    finally:
+      with self.lock:
+        self.num_queued -= 1
+    if not acquired:
+      raise RequestRejected('The request deadline passed while it was queued.')
+
+    try:
+      start_time = time.monotonic()
+      yield
+      service_time = time.monotonic() - start_time
+      with self.lock:
+        if self.service_time is None:
+          self.service_time = service_time
+        else:
+          self.service_time += SERVICE_TIME_SMOOTHING * (service_time - self.service_time)
+    finally:
+      self.semaphore.release()
+
+  @staticmethod
+  def check_deadline(deadline):
+    """Sheds a request that is served past its deadline."""
+    if time.monotonic() > deadline:
+      raise RequestRejected('The request deadline passed while it was served.')
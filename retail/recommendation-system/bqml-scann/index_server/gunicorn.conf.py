@@ -0,0 +1,27 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+threads = int(os.environ.get('THREADS', 8))
+
+# With ADMISSION_CONTROL, requests must queue in the server, where their
+# deadlines are enforced, rather than in gunicorn. So there is a thread for
+# each request in flight or in queue, and REJECTING_THREADS more, that reject
+# the requests beyond the queue as they arrive.
+if os.environ.get('ADMISSION_CONTROL', 'false').lower() == 'true':
+  threads = (
+    int(os.environ.get('MAX_CONCURRENT_REQUESTS', 4)) +
+    int(os.environ.get('MAX_QUEUED_REQUESTS', 16)) +
+    int(os.environ.get('REJECTING_THREADS', 4)))
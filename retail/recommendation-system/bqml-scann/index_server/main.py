@@ -13,22 +13,66 @@
 # limitations under the License.
 
 import os
+import time
 from flask import Flask
 from flask import request
 from flask import jsonify
 
 from lookup import EmbeddingLookup
-from matching import ScaNNMatcher
+from matching import load_matcher, SearchEffortController
+from admission import AdmissionController, RequestRejected
+from registry import IndexRegistry
 
 PROJECT_ID = os.environ['PROJECT_ID']
 REGION = os.environ['REGION']
 EMBEDDNIG_LOOKUP_MODEL_NAME = os.environ['EMBEDDNIG_LOOKUP_MODEL_NAME']
 EMBEDDNIG_LOOKUP_MODEL_VERSION = os.environ['EMBEDDNIG_LOOKUP_MODEL_VERSION']
-INDEX_DIR = os.environ['INDEX_DIR']
 PORT = os.environ['PORT']
-
-
-scann_matcher = ScaNNMatcher(INDEX_DIR)
+# Serves the single index in INDEX_DIR, or, if MODEL_REGISTRY_URI is set, the
+# index of the model and version of each request, from the model registry
+# that the TFX pipeline pushes to, within MEMORY_BUDGET_MB.
+INDEX_DIR = os.environ.get('INDEX_DIR', None)
+MODEL_REGISTRY_URI = os.environ.get('MODEL_REGISTRY_URI', None)
+MEMORY_BUDGET_MB = float(os.environ.get('MEMORY_BUDGET_MB', 4096))
+# One of 'scann', 'exact', or 'auto' to select the fastest for each index.
+MATCHER_ENGINE = os.environ.get('MATCHER_ENGINE', 'auto')
+# Lowers the search effort below the index defaults when the search latency or
+# the queue depth is above the thresholds. The queue depth is the number of
+# requests queued by the admission control, or else the number of searches in
+# flight, which excludes the requests waiting on the embedding lookup.
+ADAPTIVE_SEARCH_EFFORT = os.environ.get('ADAPTIVE_SEARCH_EFFORT', 'false').lower() == 'true'
+SEARCH_LATENCY_THRESHOLD_MS = float(os.environ.get('SEARCH_LATENCY_THRESHOLD_MS', 50))
+MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 4))
+# Bounds the requests in flight and in queue, and rejects the requests that
+# cannot complete before their deadline instead of queuing them. The deadline
+# is a time budget in milliseconds, from the DEADLINE_HEADER header or the
+# deadline_ms field of the instance. It counts from the time in seconds since
+# the epoch of the REQUEST_START_HEADER header, as set by a front end, so that
+# the time queued before the server is in the budget, or else from the time
+# the server handles the request.
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'false').lower() == 'true'
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 4))
+MAX_QUEUED_REQUESTS = int(os.environ.get('MAX_QUEUED_REQUESTS', 16))
+DEFAULT_DEADLINE_MS = float(os.environ.get('DEFAULT_DEADLINE_MS', 1000))
+DEADLINE_HEADER = 'X-Request-Deadline-Ms'
+REQUEST_START_HEADER = 'X-Request-Start'
+
+
+index_matcher = None
+index_registry = None
+if MODEL_REGISTRY_URI:
+  index_registry = IndexRegistry(
+    MODEL_REGISTRY_URI, int(MEMORY_BUDGET_MB * 1024 * 1024), MATCHER_ENGINE)
+else:
+  index_matcher = load_matcher(INDEX_DIR, MATCHER_ENGINE)
+admission_controller = None
+if ADMISSION_CONTROL:
+  admission_controller = AdmissionController(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS)
+effort_controller = None
+if ADAPTIVE_SEARCH_EFFORT:
+  effort_controller = SearchEffortController(
+    SEARCH_LATENCY_THRESHOLD_MS / 1000, MAX_QUEUE_DEPTH,
+    (lambda: admission_controller.num_queued) if admission_controller else None)
 embedding_lookup = EmbeddingLookup(
     PROJECT_ID, REGION, EMBEDDNIG_LOOKUP_MODEL_NAME, EMBEDDNIG_LOOKUP_MODEL_VERSION)
 
@@ -40,41 +84,135 @@ def health(model, version):
   return jsonify({})
 
 
+@app.route("/v1/indexes", methods=["GET"])
+def indexes():
+  if index_registry is None:
+    return jsonify({'indexes': [{'index_dir': INDEX_DIR, 'engine': index_matcher.engine}]})
+  return jsonify(index_registry.report())
+
+
 @app.route("/v1/models/<model>/versions/<version>:predict", methods=["POST"])
 def predict(model, version):
+  # Time budgets count from the arrival of the request, before its body is parsed.
+  arrival_time = get_arrival_time(request.headers.get(REQUEST_START_HEADER))
   result = 'predictions'
+  status = 200
   try:
     data = request.get_json()['instances'][0]
     query = data.get('query', None)
     show = data.get('show', 10)
     if not str(show).isdigit(): show = 10
+    leaves_to_search = data.get('leaves_to_search', None)
+    pre_reorder_num_neighbors = data.get('pre_reorder_num_neighbors', None)
+    deadline_ms = request.headers.get(DEADLINE_HEADER, data.get('deadline_ms', DEFAULT_DEADLINE_MS))
 
-    is_valid, error = validate_request(query, show)
+    is_valid, error = validate_request(
+      query, show, leaves_to_search, pre_reorder_num_neighbors, deadline_ms)
 
     if not is_valid: 
       value = error
+    elif admission_controller is None:
+      matcher = get_matcher(model, version)
+      value = match(matcher, query, int(show), leaves_to_search, pre_reorder_num_neighbors)
     else:
-      vector = embedding_lookup.lookup([query])[0]
-      value = scann_matcher.match(vector, int(show))
+      deadline = arrival_time + float(deadline_ms) / 1000
+      with admission_controller.admit(deadline):
+        matcher = get_matcher(model, version)
+        value = match(
+          matcher, query, int(show), leaves_to_search, pre_reorder_num_neighbors, deadline)
+
+  except RequestRejected as error:
+    # Rejected and shed requests fail fast, so that callers can retry elsewhere.
+    value = str(error)
+    result = 'error'
+    status = 503
 
   except Exception as error:
     value = 'Unexpected error: {}'.format(error)
     result = 'error'
 
   response = jsonify({result: value})
-  return response
+  return response, status
 
 
-def validate_request(query, show):
+def get_arrival_time(request_start):
+  """Returns the time.monotonic() time of the request start, or else now."""
+  now = time.monotonic()
+  if not request_start:
+    return now
+  # Front ends such as nginx prefix the time with t=.
+  if request_start.startswith('t='):
+    request_start = request_start[2:]
+  try:
+    queued_time = time.time() - float(request_start)
+  except ValueError:
+    return now
+  # A start in the future is clock skew with the front end.
+  return now - max(0., queued_time)
+
+
+def get_matcher(model, version):
+  if index_registry is None:
+    return index_matcher
+  return index_registry.get(model, version)
+
+
+def match(matcher, query, show, leaves_to_search, pre_reorder_num_neighbors, deadline=None):
+  if effort_controller is None:
+    vector = embedding_lookup.lookup([query])[0]
+    if deadline is not None:
+      AdmissionController.check_deadline(deadline)
+    value = matcher.match(vector, show, leaves_to_search, pre_reorder_num_neighbors)
+    # Late results are shed too, so that callers do not use them past their deadline.
+    if deadline is not None:
+      AdmissionController.check_deadline(deadline)
+    return value
+
+  vector = embedding_lookup.lookup([query])[0]
+  if deadline is not None:
+    AdmissionController.check_deadline(deadline)
+  # The search effort of the request, if any, takes precedence.
+  default_leaves_to_search, default_pre_reorder_num_neighbors = effort_controller.get_effort(matcher)
+  if leaves_to_search is None:
+    leaves_to_search = default_leaves_to_search
+  if pre_reorder_num_neighbors is None:
+    pre_reorder_num_neighbors = default_pre_reorder_num_neighbors
+  # Only the search is tracked, as requests waiting on the embedding lookup
+  # do not load the index.
+  with effort_controller.track_request():
+    start_time = time.monotonic()
+    value = matcher.match(vector, show, leaves_to_search, pre_reorder_num_neighbors)
+    effort_controller.record_latency(time.monotonic() - start_time)
+  if deadline is not None:
+    AdmissionController.check_deadline(deadline)
+  return value
+
+
+def validate_request(
+  query, show, leaves_to_search=None, pre_reorder_num_neighbors=None, deadline_ms=DEFAULT_DEADLINE_MS):
   is_valid = True
   error = ''
 
   if not query:
     is_valid = False
     error = 'You need to provide the item Id(s) in the query!'
+  elif any(value is not None and (type(value) != int or value < 1)
+           for value in [leaves_to_search, pre_reorder_num_neighbors]):
+    is_valid = False
+    error = 'The leaves_to_search and pre_reorder_num_neighbors must be positive integers!'
+  elif not _is_positive_number(deadline_ms):
+    is_valid = False
+    error = 'The deadline must be a positive number of milliseconds!'
 
   return is_valid, error
 
 
+def _is_positive_number(value):
+  try:
+    return float(value) > 0
+  except (TypeError, ValueError):
+    return False
+
+
 if __name__ == '__main__':
   app.run(host='0.0.0.0', port=PORT)
\ No newline at end of file
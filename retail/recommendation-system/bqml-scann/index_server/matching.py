@@ -17,24 +17,298 @@ import numpy as np
 import scann
 import pickle
 import os
+import io
+import json
+import time
+import threading
+import contextlib
+import collections
 
 TOKENS_FILE_NAME = 'tokens'
+EMBEDDINGS_FILE_NAME = 'embeddings.npy'
+PROJECTION_FILE_NAME = 'projection.npz'
+SEARCH_CONFIG_FILE_NAME = 'search_config.json'
+# Search effort of the indexes built before their search config was saved,
+# as set in index_builder.
+DEFAULT_NUM_LEAVES_TO_SEARCH = 200
+DEFAULT_REORDER_NUM_NEIGHBOURS = 200
+ENGINES = ['auto', 'exact', 'scann']
+EMBEDDINGS_BLOCK_SIZE = 32768
+MAX_EXACT_CATALOG_SIZE = 1000000
+NUM_CALIBRATION_QUERIES = 50
+EFFORT_RATIOS = (1., 0.5, 0.25, 0.125)
+LATENCY_WINDOW_SIZE = 200
+MIN_LATENCY_SAMPLES = 20
+ADJUST_INTERVAL_SECONDS = 5.
+RESTORE_LATENCY_RATIO = 0.5
 
 
-class ScaNNMatcher(object):
+class Matcher(object):
+  """Common interface of the matching engines.
+
+  Engines implement search, which takes a normalized and projected query, and
+  returns the indices of the top matches.
+  """
+
+  engine = None
+  # The default search effort of the index, for the engines that have one.
+  num_leaves = None
+  num_leaves_to_search = None
+  reorder_num_neighbours = None
 
   def __init__(self, index_dir):
-    print('Loading ScaNN index...')
-    scann_module = tf.saved_model.load(index_dir)
-    self.scann_index = scann.scann_ops.searcher_from_module(scann_module)
     tokens_file_path = os.path.join(index_dir, TOKENS_FILE_NAME)
     with tf.io.gfile.GFile(tokens_file_path, 'rb') as handle:
       self.tokens = pickle.load(handle)
-    print('ScaNN index is loadded.')
+    self.projection = load_projection(index_dir)
 
-  def match(self, vector, num_matches=10):
-    embedding = np.array(vector)
+  def project(self, vector):
+    """Normalizes the query vector, and applies the index projection if any."""
+    embedding = np.asarray(vector, dtype=np.float32)
     query = embedding / np.linalg.norm(embedding)
-    matche_indices, _ = self.scann_index.search(query, final_num_neighbors=num_matches)
-    match_tokens = [self.tokens[match_idx] for match_idx in matche_indices.numpy()]
-    return match_tokens
+    if self.projection is None:
+      return query
+    mean, components = self.projection
+    query = np.dot(query - mean, components)
+    return query / np.linalg.norm(query)
+
+  def search(self, query, num_matches, leaves_to_search=None, pre_reorder_num_neighbors=None):
+    raise NotImplementedError()
+
+  def match(self, vector, num_matches=10, leaves_to_search=None, pre_reorder_num_neighbors=None):
+    """Returns the tokens of the top matches of the vector.
+
+    leaves_to_search and pre_reorder_num_neighbors override the search effort
+    the index was built with. None keeps the index defaults. Exact engines
+    ignore them.
+    """
+    match_indices = self.search(
+      self.project(vector), num_matches, leaves_to_search, pre_reorder_num_neighbors)
+    return [self.tokens[match_idx] for match_idx in match_indices]
+
+
+class ScaNNMatcher(Matcher):
+
+  engine = 'scann'
+
+  def __init__(self, index_dir):
+    print('Loading ScaNN index...')
+    super(ScaNNMatcher, self).__init__(index_dir)
+    scann_module = tf.saved_model.load(index_dir)
+    self.scann_index = scann.scann_ops.searcher_from_module(scann_module)
+    search_config = load_search_config(index_dir)
+    self.num_leaves = search_config.get('num_leaves')
+    self.num_leaves_to_search = search_config.get(
+      'num_leaves_to_search', DEFAULT_NUM_LEAVES_TO_SEARCH)
+    self.reorder_num_neighbours = search_config.get(
+      'reorder_num_neighbours', DEFAULT_REORDER_NUM_NEIGHBOURS)
+    print('ScaNN index is loadded.')
+
+  def search(self, query, num_matches, leaves_to_search=None, pre_reorder_num_neighbors=None):
+    if leaves_to_search is not None and self.num_leaves:
+      leaves_to_search = min(leaves_to_search, self.num_leaves)
+    if pre_reorder_num_neighbors is not None:
+      pre_reorder_num_neighbors = max(pre_reorder_num_neighbors, num_matches)
+    matche_indices, _ = self.scann_index.search(
+      query, final_num_neighbors=num_matches,
+      pre_reorder_num_neighbors=pre_reorder_num_neighbors,
+      leaves_to_search=leaves_to_search)
+    return matche_indices.numpy()
+
+
+class ExactMatcher(Matcher):
+  """Matches against all the embeddings of the index, for small catalogs."""
+
+  engine = 'exact'
+
+  def __init__(self, index_dir):
+    print('Loading embeddings for exact matching...')
+    super(ExactMatcher, self).__init__(index_dir)
+    with tf.io.gfile.GFile(os.path.join(index_dir, EMBEDDINGS_FILE_NAME), 'rb') as handle:
+      embeddings = np.load(io.BytesIO(handle.read()))
+    self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    print(f'{self.embeddings.shape[0]} embeddings are loaded.')
+
+  def search(self, query, num_matches, leaves_to_search=None, pre_reorder_num_neighbors=None):
+    """Scores the embeddings in blocks of EMBEDDINGS_BLOCK_SIZE.
+
+    Each block is multiplied with the query, and only its top matches are kept
+    with partial selection, so the scores are never sorted in full.
+    """
+    num_matches = min(num_matches, self.embeddings.shape[0])
+    top_indices = np.empty(0, dtype=np.int64)
+    top_scores = np.empty(0, dtype=np.float32)
+
+    for start in range(0, self.embeddings.shape[0], EMBEDDINGS_BLOCK_SIZE):
+      block_scores = np.dot(self.embeddings[start: start + EMBEDDINGS_BLOCK_SIZE], query)
+      scores = np.concatenate([top_scores, block_scores])
+      indices = np.concatenate([top_indices, np.arange(start, start + block_scores.shape[0])])
+      if scores.shape[0] > num_matches:
+        selected = np.argpartition(-scores, num_matches - 1)[:num_matches]
+        scores, indices = scores[selected], indices[selected]
+      top_scores, top_indices = scores, indices
+
+    order = np.argsort(-top_scores, kind='stable')
+    return top_indices[order]
+
+
+def load_projection(index_dir):
+  """Loads the (mean, components) projection of the index, or None."""
+  projection_file_path = os.path.join(index_dir, PROJECTION_FILE_NAME)
+  if not tf.io.gfile.exists(projection_file_path):
+    return None
+  with tf.io.gfile.GFile(projection_file_path, 'rb') as handle:
+    projection = np.load(io.BytesIO(handle.read()))
+    return projection['mean'], projection['components']
+
+
+def load_search_config(index_dir):
+  """Loads the leaves and default search effort of the index, or an empty dict."""
+  search_config_file_path = os.path.join(index_dir, SEARCH_CONFIG_FILE_NAME)
+  if not tf.io.gfile.exists(search_config_file_path):
+    return {}
+  with tf.io.gfile.GFile(search_config_file_path, 'r') as handle:
+    return json.load(handle)
+
+
+def _get_catalog_size(index_dir):
+  """Returns the number of embeddings of the index, or 0 if they are not saved."""
+  embeddings_file_path = os.path.join(index_dir, EMBEDDINGS_FILE_NAME)
+  if not tf.io.gfile.exists(embeddings_file_path):
+    return 0
+  with tf.io.gfile.GFile(embeddings_file_path, 'rb') as handle:
+    version = np.lib.format.read_magic(handle)
+    if version == (1, 0):
+      shape, _, _ = np.lib.format.read_array_header_1_0(handle)
+    else:
+      shape, _, _ = np.lib.format.read_array_header_2_0(handle)
+  return shape[0]
+
+
+def measure_latency(matcher, queries, num_matches=10):
+  """Returns the median latency of the matcher over the queries, in seconds."""
+  matcher.search(queries[0], num_matches)
+  latencies = []
+  for query in queries:
+    start_time = time.perf_counter()
+    matcher.search(query, num_matches)
+    latencies.append(time.perf_counter() - start_time)
+  return float(np.median(latencies))
+
+
+def load_matcher(index_dir, engine='auto'):
+  """Loads the index with an engine, or with the fastest one if engine is 'auto'.
+
+  In 'auto', indexes without saved embeddings or with more than
+  MAX_EXACT_CATALOG_SIZE embeddings use ScaNN. Otherwise both engines are
+  loaded and timed on NUM_CALIBRATION_QUERIES of the indexed embeddings, and
+  the faster one is kept.
+  """
+  if engine not in ENGINES:
+    raise ValueError(f'Engine {engine} is not one of {ENGINES}.')
+  if engine == 'scann':
+    return ScaNNMatcher(index_dir)
+  if engine == 'exact':
+    return ExactMatcher(index_dir)
+
+  catalog_size = _get_catalog_size(index_dir)
+  if not catalog_size or catalog_size > MAX_EXACT_CATALOG_SIZE:
+    print(f'ScaNN is selected for a catalog of {catalog_size or "unknown"} size.')
+    return ScaNNMatcher(index_dir)
+
+  exact_matcher = ExactMatcher(index_dir)
+  scann_matcher = ScaNNMatcher(index_dir)
+  queries = exact_matcher.embeddings[
+    np.random.RandomState(0).choice(catalog_size, NUM_CALIBRATION_QUERIES)]
+  latencies = {
+    matcher.engine: measure_latency(matcher, queries) for matcher in [exact_matcher, scann_matcher]}
+  selected_matcher = exact_matcher if latencies['exact'] <= latencies['scann'] else scann_matcher
+  selected_matcher.latencies = latencies
+  print(f'{selected_matcher.engine} is selected for a catalog of {catalog_size} size, '
+        f'with median latencies {latencies}.')
+  return selected_matcher
+
+
+class SearchEffortController(object):
+  """Lowers the search effort when the server is overloaded, and restores it after.
+
+  The effort levels go from the index defaults down to EFFORT_RATIOS of the
+  num_leaves_to_search and reorder_num_neighbours of each index. Every
+  ADJUST_INTERVAL_SECONDS at most, the controller moves one level down when the
+  95th percentile of the recent search latencies is above latency_threshold or
+  the queue depth is above max_queue_depth, and one level up when the latency
+  is below RESTORE_LATENCY_RATIO of the threshold and the queue is half empty.
+
+  The queue depth is the number of requests waiting, from get_queue_depth, or
+  the number of searches in flight, within track_request, if get_queue_depth
+  is None.
+  """
+
+  def __init__(self, latency_threshold, max_queue_depth, get_queue_depth=None):
+    self.get_queue_depth = get_queue_depth
+    self.latency_threshold = latency_threshold
+    self.max_queue_depth = max_queue_depth
+    self.level = 0
+    self.queue_depth = 0
+    self.latencies = collections.deque(maxlen=LATENCY_WINDOW_SIZE)
+    self.last_adjusted = time.monotonic()
+    self.lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def track_request(self):
+    """Counts a search as in flight while the context is open."""
+    with self.lock:
+      self.queue_depth += 1
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.queue_depth -= 1
+
+  def get_effort(self, matcher):
+    """Returns the (leaves_to_search, pre_reorder_num_neighbors) of the current level.
+
+    The first level, and the engines without a search effort, keep the index
+    defaults, as (None, None).
+    """
+    with self.lock:
+      level = self.level
+    if level == 0 or matcher.num_leaves_to_search is None:
+      return None, None
+    ratio = EFFORT_RATIOS[level]
+    return (max(1, int(matcher.num_leaves_to_search * ratio)),
+            max(1, int(matcher.reorder_num_neighbours * ratio)))
+
+  def record_latency(self, latency):
+    with self.lock:
+      self.latencies.append(latency)
+      self._adjust()
+
+  def _adjust(self):
+    now = time.monotonic()
+    if now - self.last_adjusted < ADJUST_INTERVAL_SECONDS:
+      return
+
+    latency = None
+    if len(self.latencies) >= MIN_LATENCY_SAMPLES:
+      latency = np.percentile(self.latencies, 95)
+    queue_depth = self.get_queue_depth() if self.get_queue_depth else self.queue_depth
+    overloaded = (
+      (latency is not None and latency > self.latency_threshold)
+      or queue_depth > self.max_queue_depth)
+    recovered = (
+      latency is not None and latency < self.latency_threshold * RESTORE_LATENCY_RATIO
+      and queue_depth <= self.max_queue_depth // 2)
+
+    if overloaded and self.level < len(EFFORT_RATIOS) - 1:
+      self.level += 1
+    elif recovered and self.level > 0:
+      self.level -= 1
+    else:
+      return
+
+    # Latencies of the previous level do not tell about the new one.
+    self.latencies.clear()
+    self.last_adjusted = now
+    print(f'Search effort is set to level {self.level}: {EFFORT_RATIOS[self.level]} of the index defaults, '
+          f'with p95 latency {latency} and queue depth {queue_depth}.')
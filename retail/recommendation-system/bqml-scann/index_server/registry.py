@@ -0,0 +1,169 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import time
+import threading
+import collections
+import tensorflow as tf
+
+from matching import load_matcher, EMBEDDINGS_FILE_NAME
+
+LATEST_VERSION = 'latest'
+LATEST_VERSION_TTL_SECONDS = 60
+MODEL_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+VERSION_PATTERN = re.compile(r'[0-9]+')
+
+
+def get_dir_size(dir_path, excluded_file_names=()):
+  size = 0
+  for root, _, file_names in tf.io.gfile.walk(dir_path):
+    for file_name in file_names:
+      if file_name not in excluded_file_names:
+        size += tf.io.gfile.stat(os.path.join(root, file_name)).length
+  return size
+
+
+class IndexRegistry(object):
+  """Loads the indexes of a model registry on demand, within a memory budget.
+
+  The registry has the layout of the TFX Pusher, {registry_uri}/{model}/{version},
+  where each version directory holds an index and its tokens. The version
+  'latest' resolves to the most recent pushed version, which is looked up
+  again at most every LATEST_VERSION_TTL_SECONDS. The memory of an
+  index is estimated with the size of the files its engine loads, so the
+  embeddings only count for the exact engine. When loading an index would
+  exceed memory_budget_bytes, the least recently used indexes are evicted
+  first. Each index is loaded with the matching engine, or the fastest one
+  for its catalog if engine is 'auto'.
+  """
+
+  def __init__(self, registry_uri, memory_budget_bytes, engine='auto'):
+    self.registry_uri = registry_uri
+    self.memory_budget_bytes = memory_budget_bytes
+    self.engine = engine
+    self.indexes = collections.OrderedDict()
+    self.lock = threading.Lock()
+    # Loads one index at a time, so that the budget holds while several
+    # requests load indexes.
+    self.load_lock = threading.Lock()
+    # The resolved latest version and resolution time of each model.
+    self.latest_versions = {}
+
+  def resolve_version(self, model, version):
+    # Names come from request paths, so they must not escape the registry.
+    if not MODEL_NAME_PATTERN.fullmatch(model):
+      raise ValueError(f'Model name {model} is not valid.')
+    if version != LATEST_VERSION:
+      if not VERSION_PATTERN.fullmatch(version):
+        raise ValueError(f'Version {version} is not valid, it must be a number or {LATEST_VERSION}.')
+      return version
+
+    with self.lock:
+      latest = self.latest_versions.get(model)
+    if latest and time.monotonic() - latest[1] < LATEST_VERSION_TTL_SECONDS:
+      return latest[0]
+
+    model_dir = os.path.join(self.registry_uri, model)
+    if not tf.io.gfile.isdir(model_dir):
+      raise ValueError(f'Model {model} is not in the registry {self.registry_uri}.')
+    # Pusher versions are timestamps, so the latest one sorts last.
+    versions = [name.rstrip('/') for name in tf.io.gfile.listdir(model_dir)]
+    versions = [name for name in versions if VERSION_PATTERN.fullmatch(name)]
+    if not versions:
+      raise ValueError(f'Model {model} has no versions in the registry.')
+    latest_version = max(versions, key=int)
+    with self.lock:
+      self.latest_versions[model] = (latest_version, time.monotonic())
+    return latest_version
+
+  def get(self, model, version):
+    """Returns the matcher of the model version, and loads it if needed."""
+    key = (model, self.resolve_version(model, version))
+    with self.lock:
+      entry = self._touch(key)
+    if entry:
+      return entry['matcher']
+
+    with self.load_lock:
+      # Another request may have loaded the index while this one waited.
+      with self.lock:
+        entry = self._touch(key)
+      if entry:
+        return entry['matcher']
+
+      index_dir = os.path.join(self.registry_uri, *key)
+      if not tf.io.gfile.isdir(index_dir):
+        raise ValueError(f'Version {key[1]} of model {model} is not in the registry.')
+      # The engine is only known once the index is loaded, so the embeddings,
+      # which only the exact engine loads, are counted after.
+      memory_bytes = get_dir_size(index_dir, excluded_file_names=[EMBEDDINGS_FILE_NAME])
+      self._reserve(index_dir, memory_bytes)
+
+      start_time = time.time()
+      matcher = load_matcher(index_dir, self.engine)
+      if matcher.engine == 'exact':
+        embeddings_bytes = tf.io.gfile.stat(os.path.join(index_dir, EMBEDDINGS_FILE_NAME)).length
+        memory_bytes += embeddings_bytes
+        self._reserve(index_dir, memory_bytes)
+      with self.lock:
+        self.indexes[key] = {
+          'matcher': matcher,
+          'index_dir': index_dir,
+          'engine': matcher.engine,
+          'memory_bytes': memory_bytes,
+          'load_time': time.time() - start_time,
+          'loaded_at': time.time(),
+          'last_used': time.time(),
+          'num_requests': 1,
+        }
+      print(f'Index {key} of {memory_bytes} bytes is loaded from {index_dir}.')
+      return matcher
+
+  def _reserve(self, index_dir, memory_bytes):
+    """Evicts the least recently used indexes until memory_bytes fit the budget."""
+    if memory_bytes > self.memory_budget_bytes:
+      raise ValueError(
+        f'Index {index_dir} needs {memory_bytes} bytes, more than the memory '
+        f'budget of {self.memory_budget_bytes} bytes.')
+    with self.lock:
+      while self.indexes and self._get_memory_bytes() + memory_bytes > self.memory_budget_bytes:
+        evicted_key, evicted = self.indexes.popitem(last=False)
+        print(f'Index {evicted_key} is evicted, {evicted["memory_bytes"]} bytes are released.')
+
+  def _touch(self, key):
+    entry = self.indexes.get(key)
+    if entry:
+      self.indexes.move_to_end(key)
+      entry['last_used'] = time.time()
+      entry['num_requests'] += 1
+    return entry
+
+  def _get_memory_bytes(self):
+    return sum(entry['memory_bytes'] for entry in self.indexes.values())
+
+  def report(self):
+    """Returns the memory usage of the registry and of each loaded index."""
+    with self.lock:
+      return {
+        'memory_budget_bytes': self.memory_budget_bytes,
+        'memory_bytes': self._get_memory_bytes(),
+        'indexes': [
+          dict(model=model, version=version,
+               **{name: value for name, value in entry.items() if name != 'matcher'})
+          # Most recently used first.
+          for (model, version), entry in reversed(self.indexes.items())
+        ]
+      }
@@ -16,8 +16,11 @@
 import os
 import warnings
 import logging
+import hashlib
+import json
 
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 
 import tfx
 import tensorflow as tf
@@ -28,6 +31,113 @@ from tfx.dsl.component.experimental.annotations import InputArtifact, OutputArti
 
 from tfx.types.standard_artifacts import Model as BQModel
 
+FINGERPRINT_LABEL = 'content_fingerprint'
+FINGERPRINT_LENGTH = 40
+ITEM_GROUPS_VIEW = 'vw_item_groups'
+
+
+def _compute_fingerprint(*parts):
+  hasher = hashlib.sha256()
+  for part in parts:
+    hasher.update(str(part).encode())
+    hasher.update(b'|')
+  # BigQuery label values are limited to 63 characters.
+  return hasher.hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def _compute_table_fingerprint(client, table):
+  """Fingerprints the content of a table or view, independently of row order.
+
+  Row fingerprints are summed in BIGNUMERIC, which does not overflow and,
+  unlike BIT_XOR, does not cancel out rows that appear an even number of times.
+  """
+  query = f'''
+    SELECT
+      COUNT(*) AS num_rows,
+      CAST(SUM(CAST(FARM_FINGERPRINT(TO_JSON_STRING(t)) AS BIGNUMERIC)) AS STRING) AS fingerprint
+    FROM `{table}` t
+  '''
+  row = list(client.query(query).result())[0]
+  return _compute_fingerprint(table, row.num_rows, row.fingerprint)
+
+
+def _get_fingerprint_label(resource):
+  if resource is None or not resource.labels:
+    return None
+  return resource.labels.get(FINGERPRINT_LABEL)
+
+
+def _get_table(client, table):
+  try:
+    return client.get_table(table)
+  except NotFound:
+    return None
+
+
+def _get_model(client, model):
+  try:
+    return client.get_model(model)
+  except NotFound:
+    return None
+
+
+def _set_fingerprint_label(resource, fingerprint, update_fn):
+  resource.labels = {**(resource.labels or {}), FINGERPRINT_LABEL: fingerprint}
+  update_fn(resource, ['labels'])
+
+
+def _get_job_statistics(client, query_job):
+  """Collects the cost and timing statistics of a script job and its child jobs."""
+  statistics = {
+    'bq_job_id': '',
+    'bq_total_slot_ms': 0,
+    'bq_total_bytes_processed': 0,
+    'bq_total_bytes_billed': 0,
+    'bq_elapsed_ms': 0,
+    'bq_num_child_jobs': 0,
+    'bq_num_cache_hits': 0,
+    'bq_stage_timings': '[]',
+  }
+  if query_job is None:
+    return statistics
+  
+  child_jobs = list(client.list_jobs(parent_job=query_job.job_id))
+  stage_timings = []
+  for job in reversed(child_jobs):
+    for stage in job.query_plan or []:
+      elapsed_ms = None
+      if stage.start and stage.end:
+        elapsed_ms = int((stage.end - stage.start).total_seconds() * 1000)
+      stage_timings.append({
+        'job_id': job.job_id,
+        'stage': stage.name,
+        'slot_ms': stage.slot_ms,
+        'elapsed_ms': elapsed_ms,
+        'records_read': stage.records_read,
+        'records_written': stage.records_written,
+      })
+  
+  statistics.update({
+    'bq_job_id': query_job.job_id,
+    'bq_total_slot_ms': query_job.slot_millis or 0,
+    'bq_total_bytes_processed': query_job.total_bytes_processed or 0,
+    'bq_total_bytes_billed': query_job.total_bytes_billed or 0,
+    'bq_elapsed_ms': int((query_job.ended - query_job.started).total_seconds() * 1000),
+    'bq_num_child_jobs': len(child_jobs),
+    'bq_num_cache_hits': sum(1 for job in child_jobs if job.cache_hit),
+    'bq_stage_timings': json.dumps(stage_timings),
+  })
+  return statistics
+
+
+def _set_job_statistics(artifact, statistics):
+  for name, value in statistics.items():
+    if isinstance(value, str):
+      artifact.set_string_custom_property(name, value)
+    else:
+      artifact.set_int_custom_property(name, int(value))
+  logging.info(f'BigQuery job statistics: {statistics}')
+
 
 @component
 def compute_pmi(
@@ -49,17 +159,31 @@ def compute_pmi(
   '''
   result_table = 'item_cooc'
 
-  logging.info(f'Starting computing PMI...')
-  
   client = bigquery.Client(project=project_id)
-  query_job = client.query(query)
-  query_job.result() # Wait for the job to complete
+  fingerprint = _compute_fingerprint(
+    stored_proc, min_item_frequency, max_group_size,
+    _compute_table_fingerprint(client, f'{project_id}.{bq_dataset}.{ITEM_GROUPS_VIEW}'))
+  output_table = _get_table(client, f'{project_id}.{bq_dataset}.{result_table}')
+  reused = _get_fingerprint_label(output_table) == fingerprint
+  query_job = None
   
-  logging.info(f'Items PMI computation completed. Output in {bq_dataset}.{result_table}.')
+  if reused:
+    logging.info(f'Item groups and parameters are unchanged. Reusing {bq_dataset}.{result_table}.')
+  else:
+    logging.info(f'Starting computing PMI...')
+    query_job = client.query(query)
+    query_job.result() # Wait for the job to complete
+    _set_fingerprint_label(
+      client.get_table(f'{project_id}.{bq_dataset}.{result_table}'), 
+      fingerprint, client.update_table)
+    logging.info(f'Items PMI computation completed. Output in {bq_dataset}.{result_table}.')
   
   # Write the location of the output table to metadata.  
   item_cooc.set_string_custom_property('bq_dataset', bq_dataset)
   item_cooc.set_string_custom_property('bq_result_table', result_table)
+  item_cooc.set_string_custom_property(FINGERPRINT_LABEL, fingerprint)
+  item_cooc.set_int_custom_property('reused', int(reused))
+  _set_job_statistics(item_cooc, _get_job_statistics(client, query_job))
     
     
 @component
@@ -79,17 +203,31 @@ def train_item_matching_model(
   model_name = 'item_matching_model'
   
   logging.info(f'Using item co-occurrence table: {bq_dataset}.{item_cooc_table}')
-  logging.info(f'Starting training of the model...')
-    
+  
   client = bigquery.Client(project=project_id)
-  query_job = client.query(query)
-  query_job.result()
+  fingerprint = _compute_fingerprint(
+    stored_proc, dimensions, item_cooc.get_string_custom_property(FINGERPRINT_LABEL))
+  output_model = _get_model(client, f'{project_id}.{bq_dataset}.{model_name}')
+  reused = _get_fingerprint_label(output_model) == fingerprint
+  query_job = None
   
-  logging.info(f'Model training completed. Output in {bq_dataset}.{model_name}.')
+  if reused:
+    logging.info(f'Item co-occurrence and parameters are unchanged. Reusing {bq_dataset}.{model_name}.')
+  else:
+    logging.info(f'Starting training of the model...')
+    query_job = client.query(query)
+    query_job.result()
+    _set_fingerprint_label(
+      client.get_model(f'{project_id}.{bq_dataset}.{model_name}'), 
+      fingerprint, client.update_model)
+    logging.info(f'Model training completed. Output in {bq_dataset}.{model_name}.')
   
   # Write the location of the model to metadata.  
   bq_model.set_string_custom_property('bq_dataset', bq_dataset)
   bq_model.set_string_custom_property('bq_model_name', model_name)
+  bq_model.set_string_custom_property(FINGERPRINT_LABEL, fingerprint)
+  bq_model.set_int_custom_property('reused', int(reused))
+  _set_job_statistics(bq_model, _get_job_statistics(client, query_job))
   
   
 @component
@@ -107,14 +245,28 @@ def extract_embeddings(
   result_table = 'item_embeddings'
 
   logging.info(f'Extracting item embedding from: {bq_dataset}.{embedding_model_name}')
-  logging.info(f'Starting exporting embeddings...')
   
   client = bigquery.Client(project=project_id)
-  query_job = client.query(query)
-  query_job.result() # Wait for the job to complete
+  fingerprint = _compute_fingerprint(
+    stored_proc, bq_model.get_string_custom_property(FINGERPRINT_LABEL))
+  output_table = _get_table(client, f'{project_id}.{bq_dataset}.{result_table}')
+  reused = _get_fingerprint_label(output_table) == fingerprint
+  query_job = None
   
-  logging.info(f'Embeddings export completed. Output in {bq_dataset}.{result_table}')
+  if reused:
+    logging.info(f'Model is unchanged. Reusing {bq_dataset}.{result_table}.')
+  else:
+    logging.info(f'Starting exporting embeddings...')
+    query_job = client.query(query)
+    query_job.result() # Wait for the job to complete
+    _set_fingerprint_label(
+      client.get_table(f'{project_id}.{bq_dataset}.{result_table}'), 
+      fingerprint, client.update_table)
+    logging.info(f'Embeddings export completed. Output in {bq_dataset}.{result_table}')
   
   # Write the location of the output table to metadata.
   item_embeddings.set_string_custom_property('bq_dataset', bq_dataset)
-  item_embeddings.set_string_custom_property('bq_result_table', result_table)
\ No newline at end of file
+  item_embeddings.set_string_custom_property('bq_result_table', result_table)
+  item_embeddings.set_string_custom_property(FINGERPRINT_LABEL, fingerprint)
+  item_embeddings.set_int_custom_property('reused', int(reused))
+  _set_job_statistics(item_embeddings, _get_job_statistics(client, query_job))
\ No newline at end of file
@@ -19,6 +19,10 @@ import os
 PIPELINE_NAME=os.getenv('PIPELINE_NAME', 'bqml_scann_embedding_matching')
 EMBEDDING_LOOKUP_MODEL_NAME=os.getenv('EMBEDDING_LOOKUP_MODEL_NAME', 'embeddings_lookup')
 SCANN_INDEX_MODEL_NAME=os.getenv('SCANN_INDEX_MODEL_NAME', 'embeddings_scann')
+ENABLE_FUSED_MODEL=os.getenv('ENABLE_FUSED_MODEL', 'False')
+PROJECTION_DIMENSIONS=os.getenv('PROJECTION_DIMENSIONS', '0')
+PROJECTION_METHOD=os.getenv('PROJECTION_METHOD', 'pca')
+INDEX_TRAINING_SAMPLE_FRACTION=os.getenv('INDEX_TRAINING_SAMPLE_FRACTION', '1.0')
 PROJECT_ID=os.getenv('PROJECT_ID', 'tfx-cloudml')
 REGION=os.getenv('REGION', 'europe-west1')
 BQ_DATASET_NAME=os.getenv('BQ_DATASET_NAME', 'recommendations')
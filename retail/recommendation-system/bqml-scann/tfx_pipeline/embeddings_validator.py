@@ -0,0 +1,128 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Embeddings validator custom component.
+
+Checks the embeddings against the schema in a single vectorized pass, as a
+lightweight replacement of StatisticsGen and ExampleValidator.
+"""
+
+import os
+import json
+import logging
+
+import numpy as np
+import tensorflow as tf
+from tensorflow_metadata.proto.v0 import schema_pb2
+from tfx.types.standard_artifacts import Examples, Schema, ExampleAnomalies
+from tfx.types import artifact_utils
+from tfx.utils import io_utils
+from tfx.dsl.component.experimental.decorators import component
+from tfx.dsl.component.experimental.annotations import InputArtifact, OutputArtifact, Parameter
+
+BATCH_SIZE = 8192
+ANOMALIES_FILE_NAME = 'anomalies.json'
+MAX_ANOMALY_SAMPLES = 10
+MIN_EMBEDDING_NORM = 1e-6
+MAX_EMBEDDING_NORM = 1e4
+
+
+def _get_embedding_dimensions(schema_file_path):
+  schema = io_utils.parse_pbtxt_file(schema_file_path, schema_pb2.Schema())
+  for feature in schema.feature:
+    if feature.name == 'embedding':
+      return feature.shape.dim[0].size
+  raise ValueError(f'Embedding feature is missing from {schema_file_path}.')
+
+
+def find_anomalies(embedding_files_pattern, dimensions, min_norm, max_norm):
+  """Streams the embeddings in batches and counts the invalid ones.
+
+  Returns:
+    A dict with the number of embeddings, and the count and sample item Ids of
+    each anomaly: wrong dimensions, non-finite values, norm out of
+    [min_norm, max_norm], and duplicate item Ids.
+  """
+  features = {
+    'item_Id': tf.io.FixedLenFeature([], tf.string),
+    'embedding': tf.io.RaggedFeature(tf.float32),
+  }
+  dataset = tf.data.TFRecordDataset(
+    tf.io.gfile.glob(embedding_files_pattern), compression_type='GZIP')
+  dataset = dataset.batch(BATCH_SIZE).map(
+    lambda records: tf.io.parse_example(records, features),
+    num_parallel_calls=tf.data.experimental.AUTOTUNE).prefetch(1)
+
+  anomaly_names = ['wrong_dimensions', 'non_finite_values', 'norm_out_of_range']
+  counts = {name: 0 for name in anomaly_names}
+  samples = {name: [] for name in anomaly_names}
+  item_ids = []
+
+  for batch in dataset:
+    batch_item_ids = batch['item_Id'].numpy()
+    item_ids.append(batch_item_ids)
+    wrong_dimensions = batch['embedding'].row_lengths().numpy() != dimensions
+
+    # Only embeddings with the right dimensions are checked for values.
+    embeddings = batch['embedding'].to_tensor(shape=[None, dimensions]).numpy()
+    non_finite_values = ~wrong_dimensions & ~np.isfinite(embeddings).all(axis=1)
+    norms = np.linalg.norm(np.where(np.isfinite(embeddings), embeddings, 0.), axis=1)
+    norm_out_of_range = (
+      ~wrong_dimensions & ~non_finite_values & ((norms < min_norm) | (norms > max_norm)))
+
+    for name, invalid in zip(anomaly_names, [wrong_dimensions, non_finite_values, norm_out_of_range]):
+      counts[name] += int(invalid.sum())
+      num_samples = MAX_ANOMALY_SAMPLES - len(samples[name])
+      samples[name].extend(item_id.decode() for item_id in batch_item_ids[invalid][:num_samples])
+
+  item_ids = np.concatenate(item_ids) if item_ids else np.array([], dtype=object)
+  unique_item_ids, item_id_counts = np.unique(item_ids, return_counts=True)
+  duplicates = unique_item_ids[item_id_counts > 1]
+  counts['duplicate_item_ids'] = int(np.sum(item_id_counts[item_id_counts > 1]))
+  samples['duplicate_item_ids'] = [item_id.decode() for item_id in duplicates[:MAX_ANOMALY_SAMPLES]]
+
+  return {
+    'num_embeddings': len(item_ids),
+    'dimensions': dimensions,
+    'anomalies': {
+      name: {'count': count, 'samples': samples[name]}
+      for name, count in counts.items() if count
+    }
+  }
+
+
+@component
+def validate_embeddings(
+  examples: InputArtifact[Examples],
+  schema: InputArtifact[Schema],
+  min_norm: Parameter[float],
+  max_norm: Parameter[float],
+  anomalies: OutputArtifact[ExampleAnomalies]):
+
+  embedding_files_pattern = io_utils.all_files_pattern(
+    artifact_utils.get_split_uri([examples], 'train'))
+  dimensions = _get_embedding_dimensions(os.path.join(schema.uri, 'schema.pbtxt'))
+
+  logging.info(f'Validating {dimensions}-dimensional embeddings in {embedding_files_pattern}...')
+  results = find_anomalies(embedding_files_pattern, dimensions, min_norm, max_norm)
+  num_anomalies = sum(anomaly['count'] for anomaly in results['anomalies'].values())
+  logging.info(f'{results["num_embeddings"]} embeddings are validated, with {num_anomalies} anomalies.')
+
+  anomalies_file_path = os.path.join(anomalies.uri, ANOMALIES_FILE_NAME)
+  io_utils.write_string_file(anomalies_file_path, json.dumps(results))
+  anomalies.set_int_custom_property('num_embeddings', results['num_embeddings'])
+  anomalies.set_int_custom_property('num_anomalies', num_anomalies)
+
+  # Fail the run, so that the downstream components do not index invalid embeddings.
+  if num_anomalies:
+    raise ValueError(f'Embeddings have anomalies: {results["anomalies"]}. Details in {anomalies_file_path}.')
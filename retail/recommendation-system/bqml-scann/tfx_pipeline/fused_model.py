@@ -0,0 +1,123 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fused embedding lookup and ScaNN matching model."""
+
+import os
+import io
+import pickle
+import logging
+
+import scann
+import numpy as np
+import tensorflow as tf
+from tfx.types.standard_artifacts import Model
+from tfx.dsl.component.experimental.decorators import component
+from tfx.dsl.component.experimental.annotations import InputArtifact, OutputArtifact
+
+SERVING_MODEL_DIR = 'serving_model_dir'
+TOKENS_FILE_NAME = 'tokens'
+TOKENS_ASSET_FILE_NAME = 'tokens.txt'
+PROJECTION_FILE_NAME = 'projection.npz'
+DEFAULT_NUM_MATCHES = 10
+
+
+class FusedMatcher(tf.Module):
+  """Maps item Ids to their nearest neighbour tokens and scores in one call.
+
+  The module wraps the exported embedding lookup SavedModel and the serialized
+  ScaNN searcher, so the query embeddings never leave the TensorFlow runtime.
+  The runtime serving it needs the ScaNN custom ops to be loaded.
+  """
+
+  def __init__(self, lookup_model_dir, index_dir, tokens_dir):
+    super(FusedMatcher, self).__init__()
+    
+    logging.info('Loading embedding lookup model...')
+    self.embedding_lookup = tf.saved_model.load(lookup_model_dir)
+    logging.info('Loading ScaNN index...')
+    self.scann_module = tf.saved_model.load(index_dir)
+    self.scann_index = scann.scann_ops.searcher_from_module(self.scann_module)
+    
+    # Queries are projected like the indexed embeddings, if the index has a projection.
+    self.projection_mean = None
+    self.projection_components = None
+    projection_file_path = os.path.join(index_dir, PROJECTION_FILE_NAME)
+    if tf.io.gfile.exists(projection_file_path):
+      with tf.io.gfile.GFile(projection_file_path, 'rb') as handle:
+        projection = np.load(io.BytesIO(handle.read()))
+        self.projection_mean = tf.constant(projection['mean'])
+        self.projection_components = tf.constant(projection['components'])
+
+    # Write the index tokens as an asset, one per line in index order.
+    with tf.io.gfile.GFile(os.path.join(index_dir, TOKENS_FILE_NAME), 'rb') as handle:
+      tokens = pickle.load(handle)
+    tf.io.gfile.makedirs(tokens_dir)
+    tokens_file_path = os.path.join(tokens_dir, TOKENS_ASSET_FILE_NAME)
+    with tf.io.gfile.GFile(tokens_file_path, 'w') as f:
+      for token in tokens:
+        f.write(f'{token}\n')
+    logging.info(f'{len(tokens)} index tokens written to {tokens_file_path}.')
+
+    self.tokens_file = tf.saved_model.Asset(tokens_file_path)
+    initializer = tf.lookup.TextFileInitializer(
+        self.tokens_file, 
+        key_dtype=tf.int64, 
+        key_index=tf.lookup.TextFileIndex.LINE_NUMBER,
+        value_dtype=tf.string, 
+        value_index=tf.lookup.TextFileIndex.WHOLE_LINE)
+    self.id_to_token = tf.lookup.StaticHashTable(initializer, default_value='')
+
+  @tf.function(input_signature=[
+    tf.TensorSpec([None], tf.string), tf.TensorSpec([], tf.int32)])
+  def __call__(self, inputs, num_matches):
+    embeddings = self.embedding_lookup(inputs)
+    queries = tf.math.l2_normalize(tf.cast(embeddings, tf.float32), axis=1)
+    if self.projection_components is not None:
+      queries = tf.math.l2_normalize(
+        tf.matmul(queries - self.projection_mean, self.projection_components), axis=1)
+    match_indices, match_scores = self.scann_index.search_batched(
+      queries, final_num_neighbors=num_matches)
+    match_tokens = self.id_to_token.lookup(tf.cast(match_indices, tf.int64))
+    return {'tokens': match_tokens, 'scores': match_scores}
+
+
+def export_fused_model(lookup_model_dir, index_dir, output_dir):
+  logging.info('Instantiating fused matching model...')
+  fused_matcher = FusedMatcher(lookup_model_dir, index_dir, output_dir)
+  logging.info('Model is instantiated.')
+
+  signatures = {
+    'serving_default': fused_matcher.__call__.get_concrete_function(),
+  }
+
+  logging.info('Exporting fused matching model as a SavedModel...')
+  tf.saved_model.save(fused_matcher, output_dir, signatures=signatures)
+  # The tokens are now copied to the SavedModel assets.
+  tf.io.gfile.remove(os.path.join(output_dir, TOKENS_ASSET_FILE_NAME))
+  logging.info(f'SavedModel is exported to {output_dir}.')
+
+
+@component
+def create_fused_model(
+  embedding_lookup: InputArtifact[Model],
+  scann_index: InputArtifact[Model],
+  fused_model: OutputArtifact[Model]):
+
+  export_fused_model(
+    lookup_model_dir=os.path.join(embedding_lookup.uri, SERVING_MODEL_DIR),
+    index_dir=os.path.join(scann_index.uri, SERVING_MODEL_DIR),
+    output_dir=os.path.join(fused_model.uri, SERVING_MODEL_DIR))
+
+  fused_model.set_string_custom_property('embedding_lookup_uri', embedding_lookup.uri)
+  fused_model.set_string_custom_property('scann_index_uri', scann_index.uri)
@@ -18,9 +18,13 @@ import numpy as np
 import scann
 import pickle
 import os
+import io
 import logging
 
 TOKENS_FILE_NAME = 'tokens'
+PROJECTION_FILE_NAME = 'projection.npz'
+QUERY_BLOCK_SIZE = 1024
+EMBEDDINGS_BLOCK_SIZE = 32768
 
 
 class ScaNNMatcher(object):
@@ -32,29 +36,103 @@ class ScaNNMatcher(object):
     tokens_file_path = os.path.join(index_dir, TOKENS_FILE_NAME)
     with tf.io.gfile.GFile(tokens_file_path, 'rb') as handle:
       self.tokens = pickle.load(handle)
+    self.projection = load_projection(index_dir)
+    if self.projection is not None:
+      logging.info(f'Queries are projected to {self.projection[1].shape[1]} dimensions.')
     logging.info('ScaNN index is loaded.')
 
+  def project(self, vectors):
+    """Normalizes the query vectors, and applies the index projection if any."""
+    embeddings = np.asarray(vectors, dtype=np.float32)
+    queries = embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    if self.projection is None:
+      return queries
+    mean, components = self.projection
+    queries = np.dot(queries - mean, components)
+    return queries / np.linalg.norm(queries, axis=-1, keepdims=True)
+
   def match(self, vector, num_matches=10):
-    embedding = np.array(vector)
-    query = embedding / np.linalg.norm(embedding)
+    query = self.project(vector)
     matche_indices, _ = self.scann_index.search(query, final_num_neighbors=num_matches)
     match_tokens = [self.tokens[match_idx] for match_idx in matche_indices.numpy()]
     return match_tokens
 
+  def match_batch(self, vectors, num_matches=10):
+    queries = self.project(vectors)
+    match_indices, match_scores = self.scann_index.search_batched(
+      queries, final_num_neighbors=num_matches)
+    return match_indices.numpy(), match_scores.numpy()
+
+
+def load_projection(index_dir):
+  """Loads the (mean, components) projection of the index, or None."""
+  projection_file_path = os.path.join(index_dir, PROJECTION_FILE_NAME)
+  if not tf.io.gfile.exists(projection_file_path):
+    return None
+  with tf.io.gfile.GFile(projection_file_path, 'rb') as handle:
+    projection = np.load(io.BytesIO(handle.read()))
+    return projection['mean'], projection['components']
+
 
 class ExactMatcher(object):
   
   def __init__(self, embeddings, tokens):
     logging.info('Loading Exact index...')
-    self.embeddings = embeddings
+    self.embeddings = np.asarray(embeddings, dtype=np.float32)
     self.tokens = tokens
     logging.info('Embeddings and vocabulary are loaded.')
 
   def match(self, vector, num_matches=10):
-    embedding = np.array(vector)
-    query = embedding / np.linalg.norm(embedding)
-    similarities = np.dot(self.embeddings, query.T) 
-    matches = list(zip(self.tokens, list(similarities)))
-    matches = sorted(
-      matches, key=lambda kv: kv[1], reverse=True)[:num_matches]
-    return [kv[0] for kv in matches]
\ No newline at end of file
+    match_indices, _ = self.match_batch([vector], num_matches)
+    return [self.tokens[match_idx] for match_idx in match_indices[0]]
+
+  def match_batch(self, vectors, num_matches=10):
+    """Computes the exact top matches for a batch of query vectors.
+
+    Queries are multiplied against the embeddings in blocks of
+    QUERY_BLOCK_SIZE x EMBEDDINGS_BLOCK_SIZE, and the running top matches are
+    kept with partial selection instead of sorting all the scores.
+
+    Returns:
+      A tuple of (indices, scores) arrays of shape [num_queries, num_matches],
+      ordered by descending score.
+    """
+    queries = np.asarray(vectors, dtype=np.float32)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    num_queries = queries.shape[0]
+    num_embeddings = self.embeddings.shape[0]
+    num_matches = min(num_matches, num_embeddings)
+
+    match_indices = np.empty((num_queries, num_matches), dtype=np.int64)
+    match_scores = np.empty((num_queries, num_matches), dtype=np.float32)
+
+    for query_start in range(0, num_queries, QUERY_BLOCK_SIZE):
+      query_block = queries[query_start: query_start + QUERY_BLOCK_SIZE]
+      top_scores = np.empty((query_block.shape[0], 0), dtype=np.float32)
+      top_indices = np.empty((query_block.shape[0], 0), dtype=np.int64)
+
+      for start in range(0, num_embeddings, EMBEDDINGS_BLOCK_SIZE):
+        embeddings_block = self.embeddings[start: start + EMBEDDINGS_BLOCK_SIZE]
+        block_scores = np.dot(query_block, embeddings_block.T)
+        block_indices = np.broadcast_to(
+          np.arange(start, start + embeddings_block.shape[0]), block_scores.shape)
+        block_scores, block_indices = _select_top_k(
+          block_scores, block_indices, num_matches)
+        top_scores, top_indices = _select_top_k(
+          np.concatenate([top_scores, block_scores], axis=1),
+          np.concatenate([top_indices, block_indices], axis=1),
+          num_matches)
+
+      order = np.argsort(-top_scores, axis=1, kind='stable')
+      query_end = query_start + query_block.shape[0]
+      match_scores[query_start: query_end] = np.take_along_axis(top_scores, order, axis=1)
+      match_indices[query_start: query_end] = np.take_along_axis(top_indices, order, axis=1)
+
+    return match_indices, match_scores
+
+
+def _select_top_k(scores, indices, k):
+  if scores.shape[1] <= k:
+    return scores, indices
+  top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+  return np.take_along_axis(scores, top, axis=1), np.take_along_axis(indices, top, axis=1)
@@ -0,0 +1,182 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local stand-ins for the BigQuery components.
+
+The BigQuery dataset is replaced by a SQLite database in a local data
+directory, and the stored procedures by equivalent Python code, so that the
+pipeline can run end to end without Google Cloud.
+"""
+
+import os
+import csv
+import sqlite3
+import logging
+
+import numpy as np
+import tensorflow as tf
+from tfx.types.experimental.simple_artifacts import Dataset
+from tfx.dsl.component.experimental.decorators import component
+from tfx.dsl.component.experimental.annotations import InputArtifact, OutputArtifact, Parameter
+
+from tfx.types.standard_artifacts import Model as BQModel
+
+try:
+  from . import pmi
+  from . import matrix_factorization
+except:
+  import pmi
+  import matrix_factorization
+
+ITEM_GROUPS_FILE_NAME = 'item_groups.csv'
+EMBEDDINGS_DIR_NAME = 'item_embeddings'
+EMBEDDINGS_FILE_NAME = 'embeddings.tfrecord.gz'
+MODEL_FILE_NAME = 'item_matching_model.npz'
+
+
+def connect(data_dir, bq_dataset):
+  """Opens the SQLite database that stands in for the BigQuery dataset."""
+  return sqlite3.connect(os.path.join(data_dir, f'{bq_dataset}.db'))
+
+
+def generate_item_groups(data_dir, num_items, num_groups, max_group_size, seed=0):
+  """Writes a synthetic item_groups.csv with popularity-skewed items."""
+  random = np.random.RandomState(seed)
+  popularity = 1. / np.arange(1, num_items + 1)
+  popularity /= popularity.sum()
+
+  os.makedirs(data_dir, exist_ok=True)
+  item_groups_file_path = os.path.join(data_dir, ITEM_GROUPS_FILE_NAME)
+  with open(item_groups_file_path, 'w', newline='') as handle:
+    writer = csv.writer(handle)
+    writer.writerow(['item_Id', 'group_Id'])
+    for group_Id in range(num_groups):
+      group_size = random.randint(2, max_group_size + 1)
+      for item_Id in np.unique(random.choice(num_items, group_size, p=popularity)):
+        writer.writerow([f'item_{item_Id}', f'group_{group_Id}'])
+  logging.info(f'Sample item groups are written to {item_groups_file_path}.')
+
+
+@component
+def compute_pmi_local(
+  data_dir: Parameter[str],
+  bq_dataset: Parameter[str],
+  min_item_frequency: Parameter[int],
+  max_group_size: Parameter[int],
+  item_cooc: OutputArtifact[Dataset]):
+
+  result_table = 'item_cooc'
+
+  logging.info(f'Starting computing PMI...')
+
+  item_ids, group_ids = pmi.read_item_groups(
+    os.path.join(data_dir, ITEM_GROUPS_FILE_NAME))
+  item_cooc_rows = pmi.compute_item_cooc(
+    item_ids, group_ids, min_item_frequency, max_group_size)
+  with connect(data_dir, bq_dataset) as connection:
+    connection.execute(f'DROP TABLE IF EXISTS {result_table}')
+    connection.execute(
+      f'CREATE TABLE {result_table} (item1_Id TEXT, item2_Id TEXT, cooc INTEGER, pmi REAL)')
+    connection.executemany(
+      f'INSERT INTO {result_table} VALUES (?, ?, ?, ?)',
+      zip(item_cooc_rows['item1_Id'].tolist(), item_cooc_rows['item2_Id'].tolist(),
+          item_cooc_rows['cooc'].tolist(), item_cooc_rows['pmi'].tolist()))
+
+  logging.info(f'Items PMI computation completed. Output in {bq_dataset}.{result_table}.')
+
+  # Write the location of the output table to metadata.
+  item_cooc.set_string_custom_property('bq_dataset', bq_dataset)
+  item_cooc.set_string_custom_property('bq_result_table', result_table)
+
+
+@component
+def train_item_matching_model_local(
+  data_dir: Parameter[str],
+  bq_dataset: Parameter[str],
+  dimensions: Parameter[int],
+  item_cooc: InputArtifact[Dataset],
+  bq_model: OutputArtifact[BQModel]):
+
+  item_cooc_table = item_cooc.get_string_custom_property('bq_result_table')
+
+  logging.info(f'Using item co-occurrence table: {bq_dataset}.{item_cooc_table}')
+  logging.info(f'Starting training of the model...')
+
+  with connect(data_dir, bq_dataset) as connection:
+    rows = connection.execute(
+      f'SELECT item1_Id, item2_Id, cooc * pmi AS score FROM {item_cooc_table}').fetchall()
+  item1_ids, item2_ids, scores = zip(*rows)
+
+  # Factorize the score matrix with implicit-feedback ALS, as a stand-in for
+  # the BQML matrix factorization.
+  vocabulary, item1_factors, item2_factors = matrix_factorization.train(
+    item1_ids, item2_ids, scores, dimensions)
+
+  model_file_path = os.path.join(bq_model.uri, MODEL_FILE_NAME)
+  tf.io.gfile.makedirs(bq_model.uri)
+  np.savez(
+    model_file_path,
+    vocabulary=vocabulary,
+    item1_factors=item1_factors,
+    item2_factors=item2_factors)
+
+  logging.info(f'Model training completed. Output in {model_file_path}.')
+
+  # Write the location of the model to metadata.
+  bq_model.set_string_custom_property('bq_dataset', bq_dataset)
+  bq_model.set_string_custom_property('bq_model_name', model_file_path)
+
+
+@component
+def extract_embeddings_local(
+  data_dir: Parameter[str],
+  bq_dataset: Parameter[str],
+  bq_model: InputArtifact[BQModel],
+  item_embeddings: OutputArtifact[Dataset]):
+
+  model_file_path = bq_model.get_string_custom_property('bq_model_name')
+  result_table = 'item_embeddings'
+
+  logging.info(f'Extracting item embedding from: {model_file_path}')
+
+  # As in sp_ExractEmbeddings, an item embedding is the sum of its factors as
+  # a row item and as a column item.
+  model = np.load(model_file_path)
+  embeddings = model['item1_factors'] + model['item2_factors']
+
+  embeddings_dir = os.path.join(data_dir, EMBEDDINGS_DIR_NAME)
+  write_embeddings(embeddings_dir, model['vocabulary'], embeddings)
+
+  logging.info(f'Embeddings export completed. Output in {embeddings_dir}')
+
+  # Write the location of the output table to metadata.
+  item_embeddings.set_string_custom_property('bq_dataset', bq_dataset)
+  item_embeddings.set_string_custom_property('bq_result_table', result_table)
+
+
+def write_embeddings(embeddings_dir, vocabulary, embeddings, biases=None):
+  """Writes embeddings as gzipped tf.Examples with the item_embeddings schema."""
+  tf.io.gfile.makedirs(embeddings_dir)
+  embeddings_file_path = os.path.join(embeddings_dir, EMBEDDINGS_FILE_NAME)
+  if biases is None:
+    biases = np.zeros(len(vocabulary), dtype=np.float32)
+
+  with tf.io.TFRecordWriter(embeddings_file_path, options='GZIP') as writer:
+    for item_Id, embedding, bias in zip(vocabulary, embeddings, biases):
+      example = tf.train.Example(features=tf.train.Features(feature={
+        'item_Id': tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(item_Id).encode()])),
+        'embedding': tf.train.Feature(float_list=tf.train.FloatList(value=embedding)),
+        'bias': tf.train.Feature(float_list=tf.train.FloatList(value=[bias])),
+      }))
+      writer.write(example.SerializeToString())
+  return embeddings_file_path
@@ -0,0 +1,133 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local runner with the BigQuery stand-ins and per-component timings."""
+
+import os
+import time
+import json
+import logging
+import argparse
+
+from tfx.orchestration import metadata
+from tfx.orchestration.beam.beam_dag_runner import BeamDagRunner
+from ml_metadata.metadata_store import metadata_store
+
+import config
+import pipeline
+import local_components
+
+TIMINGS_FILE_NAME = 'timings.json'
+
+
+def get_args():
+
+  args_parser = argparse.ArgumentParser()
+
+  args_parser.add_argument(
+    '--workspace-dir',
+    help='Local directory for the data, pipeline artifacts, and metadata',
+    default='workspace'
+  )
+
+  args_parser.add_argument(
+    '--num-items',
+    help='Number of items to generate, if item_groups.csv does not exist',
+    default=2000,
+    type=int
+  )
+
+  args_parser.add_argument(
+    '--num-groups',
+    help='Number of item groups to generate, if item_groups.csv does not exist',
+    default=20000,
+    type=int
+  )
+
+  args_parser.add_argument('--min-item-frequency', default=15, type=int)
+  args_parser.add_argument('--max-group-size', default=100, type=int)
+  args_parser.add_argument('--dimensions', default=50, type=int)
+  args_parser.add_argument('--num-leaves', default=0, type=int)
+  args_parser.add_argument('--projection-dimensions', default=0, type=int)
+  args_parser.add_argument('--projection-method', default='pca', choices=['pca', 'random'])
+  args_parser.add_argument('--index-training-sample-fraction', default=1.0, type=float)
+  args_parser.add_argument('--eval-min-recall', default=0.8, type=float)
+  args_parser.add_argument('--eval-max-latency', default=0.01, type=float)
+
+  return args_parser.parse_args()
+
+
+def get_component_timings(metadata_path):
+  """Reads the wall time of each component execution from ML Metadata."""
+  store = metadata_store.MetadataStore(
+    metadata.sqlite_metadata_connection_config(metadata_path))
+  timings = {}
+  for execution in store.get_executions():
+    if 'component_id' not in execution.properties:
+      continue
+    component_id = execution.properties['component_id'].string_value
+    elapsed_time = (
+      execution.last_update_time_since_epoch - execution.create_time_since_epoch) / 1000.
+    timings[component_id] = elapsed_time
+  return timings
+
+
+def main():
+  args = get_args()
+  workspace_dir = os.path.abspath(args.workspace_dir)
+  data_dir = os.path.join(workspace_dir, 'data')
+  pipeline_root = os.path.join(workspace_dir, 'artifacts')
+  metadata_path = os.path.join(workspace_dir, 'metadata.sqlite')
+
+  if not os.path.exists(os.path.join(data_dir, local_components.ITEM_GROUPS_FILE_NAME)):
+    local_components.generate_item_groups(
+      data_dir, args.num_items, args.num_groups, args.max_group_size)
+
+  start_time = time.perf_counter()
+  BeamDagRunner().run(
+    pipeline.create_pipeline(
+      pipeline_name=config.PIPELINE_NAME,
+      pipeline_root=pipeline_root,
+      project_id=config.PROJECT_ID,
+      bq_dataset_name=config.BQ_DATASET_NAME,
+      min_item_frequency=args.min_item_frequency,
+      max_group_size=args.max_group_size,
+      dimensions=args.dimensions,
+      num_leaves=args.num_leaves,
+      eval_min_recall=args.eval_min_recall,
+      eval_max_latency=args.eval_max_latency,
+      ai_platform_training_args=None,
+      beam_pipeline_args=['--direct_running_mode=multi_processing'],
+      model_regisrty_uri=os.path.join(workspace_dir, 'model_registry'),
+      projection_dimensions=args.projection_dimensions,
+      projection_method=args.projection_method,
+      index_training_sample_fraction=args.index_training_sample_fraction,
+      local_data_dir=data_dir,
+      metadata_connection_config=metadata.sqlite_metadata_connection_config(metadata_path))
+  )
+  total_time = time.perf_counter() - start_time
+
+  timings = get_component_timings(metadata_path)
+  timings['total'] = total_time
+  for component_id, elapsed_time in timings.items():
+    logging.info(f'{component_id}: {elapsed_time:.2f} seconds')
+
+  timings_file_path = os.path.join(workspace_dir, TIMINGS_FILE_NAME)
+  with open(timings_file_path, 'w') as handle:
+    json.dump(timings, handle, indent=2)
+  logging.info(f'Component timings are written to {timings_file_path}.')
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main()
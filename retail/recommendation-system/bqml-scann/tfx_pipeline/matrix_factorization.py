@@ -0,0 +1,166 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Implicit-feedback matrix factorization with alternating least squares.
+
+Trains item embeddings from the item_cooc table like sp_TrainItemMatchingModel
+(WALS_ALPHA=1 on cooc * pmi scores), so that embedding experiments can run
+locally.
+"""
+
+import csv
+import logging
+import argparse
+import multiprocessing
+from concurrent import futures
+
+import numpy as np
+from scipy import sparse
+
+ALPHA = 1.
+L2_REG = 1.
+NUM_ITERATIONS = 20
+MAX_CHUNK_BYTES = 256 * 1024 * 1024
+
+
+def _solve_rows(feedback, factors, gramian, l2_reg, start, end):
+  """Solves the least squares problems of the rows in [start, end)."""
+  dimensions = factors.shape[1]
+  indptr = feedback.indptr[start: end + 1]
+  cols = feedback.indices[indptr[0]: indptr[-1]]
+  scores = feedback.data[indptr[0]: indptr[-1]]
+  offsets = indptr[:-1] - indptr[0]
+  has_feedback = np.diff(indptr) > 0
+
+  # The confidence is 1 + alpha * |score|, and the preference is score > 0.
+  confidence = 1. + ALPHA * np.abs(scores)
+  preference = (scores > 0).astype(np.float32)
+  col_factors = factors[cols]
+
+  # A_u = Y^T Y + Y_u^T (C_u - I) Y_u + l2_reg * I
+  weighted = col_factors * (confidence - 1.)[:, np.newaxis]
+  outer = np.einsum('ni,nj->nij', weighted, col_factors)
+  lhs = np.zeros((end - start, dimensions, dimensions), dtype=np.float32)
+  lhs[has_feedback] = np.add.reduceat(outer, offsets[has_feedback], axis=0)
+  lhs += gramian + l2_reg * np.eye(dimensions, dtype=np.float32)
+
+  # b_u = Y_u^T C_u p_u
+  weighted = col_factors * (confidence * preference)[:, np.newaxis]
+  rhs = np.zeros((end - start, dimensions), dtype=np.float32)
+  rhs[has_feedback] = np.add.reduceat(weighted, offsets[has_feedback], axis=0)
+
+  return np.linalg.solve(lhs, rhs[..., np.newaxis])[..., 0]
+
+
+def _get_chunk_boundaries(feedback, dimensions, num_workers):
+  """Splits the rows into chunks whose outer products fit in MAX_CHUNK_BYTES."""
+  max_chunk_nnz = max(1, min(
+    MAX_CHUNK_BYTES // (dimensions * dimensions * 4),
+    feedback.nnz // (num_workers * 4)))
+  boundaries = np.searchsorted(
+    feedback.indptr, np.arange(max_chunk_nnz, feedback.nnz, max_chunk_nnz))
+  return np.unique(np.concatenate([[0], boundaries, [feedback.shape[0]]]))
+
+
+def _update(feedback, factors, l2_reg, executor, num_workers):
+  """Updates all the row factors of feedback, given the column factors."""
+  gramian = factors.T @ factors
+  boundaries = _get_chunk_boundaries(feedback, factors.shape[1], num_workers)
+  results = executor.map(
+    lambda bounds: _solve_rows(feedback, factors, gramian, l2_reg, *bounds),
+    zip(boundaries[:-1], boundaries[1:]))
+  return np.concatenate(list(results), axis=0).astype(np.float32)
+
+
+def train(item1_ids, item2_ids, scores, dimensions, l2_reg=L2_REG,
+          num_iterations=NUM_ITERATIONS, num_workers=None, seed=0):
+  """Factorizes the item1 x item2 score matrix.
+
+  Row chunks are solved in parallel threads, which release the GIL in NumPy's
+  batched linear algebra.
+
+  Returns:
+    A tuple of (vocabulary, item1_factors, item2_factors).
+  """
+  vocabulary, indices = np.unique(
+    np.concatenate([np.asarray(item1_ids), np.asarray(item2_ids)]), return_inverse=True)
+  item1_indices, item2_indices = np.split(indices, 2)
+  feedback = sparse.csr_matrix(
+    (np.asarray(scores, dtype=np.float32), (item1_indices, item2_indices)),
+    shape=(len(vocabulary), len(vocabulary)))
+  feedback_t = feedback.T.tocsr()
+  logging.info(f'Factorizing {feedback.shape} matrix with {feedback.nnz} scores into {dimensions} dimensions.')
+
+  random = np.random.RandomState(seed)
+  item1_factors = random.normal(scale=0.01, size=(len(vocabulary), dimensions)).astype(np.float32)
+  item2_factors = random.normal(scale=0.01, size=(len(vocabulary), dimensions)).astype(np.float32)
+
+  num_workers = num_workers or multiprocessing.cpu_count()
+  with futures.ThreadPoolExecutor(num_workers) as executor:
+    for iteration in range(num_iterations):
+      item1_factors = _update(feedback, item2_factors, l2_reg, executor, num_workers)
+      item2_factors = _update(feedback_t, item1_factors, l2_reg, executor, num_workers)
+      logging.info(f'Iteration {iteration + 1} of {num_iterations} completed.')
+
+  return vocabulary, item1_factors, item2_factors
+
+
+def read_item_cooc(item_cooc_file_path):
+  item1_ids, item2_ids, scores = [], [], []
+  with open(item_cooc_file_path, 'r') as handle:
+    for row in csv.DictReader(handle):
+      item1_ids.append(row['item1_Id'])
+      item2_ids.append(row['item2_Id'])
+      scores.append(float(row['cooc']) * float(row['pmi']))
+  return item1_ids, item2_ids, scores
+
+
+def get_args():
+
+  args_parser = argparse.ArgumentParser()
+
+  args_parser.add_argument(
+    '--item-cooc-file',
+    help='CSV file with item1_Id, item2_Id, cooc, and pmi columns',
+    required=True
+  )
+
+  args_parser.add_argument(
+    '--output-dir',
+    help='Directory to write the item_embeddings tf.Examples to',
+    required=True
+  )
+
+  args_parser.add_argument('--dimensions', default=50, type=int)
+  args_parser.add_argument('--l2-reg', default=L2_REG, type=float)
+  args_parser.add_argument('--num-iterations', default=NUM_ITERATIONS, type=int)
+  args_parser.add_argument('--num-workers', default=None, type=int)
+
+  return args_parser.parse_args()
+
+
+def main():
+  import local_components
+
+  args = get_args()
+  item1_ids, item2_ids, scores = read_item_cooc(args.item_cooc_file)
+  vocabulary, item1_factors, item2_factors = train(
+    item1_ids, item2_ids, scores, args.dimensions, args.l2_reg,
+    args.num_iterations, args.num_workers)
+  local_components.write_embeddings(
+    args.output_dir, vocabulary, item1_factors + item2_factors)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main()
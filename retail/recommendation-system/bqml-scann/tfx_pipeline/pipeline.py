@@ -24,18 +24,26 @@ from tfx.dsl.components.base import executor_spec
 from tfx.components.trainer import executor as trainer_executor
 from tfx.extensions.google_cloud_ai_platform.trainer import executor as ai_platform_trainer_executor
 from tfx.extensions.google_cloud_big_query.example_gen.component import BigQueryExampleGen
+from tfx.components import ImportExampleGen
 from ml_metadata.proto import metadata_store_pb2
 
 try:
   from . import bq_components
   from . import scann_evaluator
+  from . import fused_model
+  from . import local_components
+  from . import embeddings_validator
 except:
   import bq_components
   import scann_evaluator
+  import fused_model
+  import local_components
+  import embeddings_validator
 
 
 EMBEDDING_LOOKUP_MODEL_NAME = 'embeddings_lookup'
 SCANN_INDEX_MODEL_NAME = 'embeddings_scann'
+FUSED_MODEL_NAME = 'embeddings_fused'
 LOOKUP_CREATOR_MODULE = 'lookup_creator.py'
 SCANN_INDEXER_MODULE = 'scann_indexer.py'
 SCHEMA_DIR = 'schema'
@@ -54,10 +62,33 @@ def create_pipeline(pipeline_name: Text,
                     ai_platform_training_args: Dict[Text, Text],
                     beam_pipeline_args: List[Text],
                     model_regisrty_uri: Text,
+                    eval_latency_percentile: Optional[
+                      data_types.RuntimeParameter] = None,
+                    eval_load_test_concurrency: Optional[
+                      data_types.RuntimeParameter] = None,
+                    eval_max_load_latency: Optional[
+                      data_types.RuntimeParameter] = None,
+                    eval_min_throughput: Optional[
+                      data_types.RuntimeParameter] = None,
+                    ground_truth_cache_uri: Optional[Text] = None,
+                    embedding_dtype: Optional[Text] = 'float32',
+                    enable_fused_model: Optional[bool] = False,
+                    index_cache_uri: Optional[Text] = None,
+                    projection_dimensions: Optional[int] = 0,
+                    projection_method: Optional[Text] = 'pca',
+                    index_training_sample_fraction: Optional[float] = 1.0,
+                    local_data_dir: Optional[Text] = None,
+                    enable_stats_validation: Optional[bool] = False,
                     metadata_connection_config: Optional[
                       metadata_store_pb2.ConnectionConfig] = None,
                     enable_cache: Optional[bool] = False) -> pipeline.Pipeline:
-  """Implements the online news pipeline with TFX."""
+  """Implements the online news pipeline with TFX.
+  
+  If local_data_dir is set, the BigQuery steps are replaced by their local
+  stand-ins, which read item groups from and write tables to that directory.
+  The embeddings are validated by the lightweight embeddings validator, or by
+  StatisticsGen and ExampleValidator if enable_stats_validation is set.
+  """
 
   
   local_executor_spec = executor_spec.ExecutorClassSpec(
@@ -66,39 +97,71 @@ def create_pipeline(pipeline_name: Text,
   caip_executor_spec = executor_spec.ExecutorClassSpec(
     ai_platform_trainer_executor.GenericExecutor)
   
-  # Compute the PMI.
-  pmi_computer = bq_components.compute_pmi(
-    project_id=project_id,
-    bq_dataset=bq_dataset_name,
-    min_item_frequency=min_item_frequency,
-    max_group_size=max_group_size
-  )
-  
-  # Train the BQML Matrix Factorization model.
-  bqml_trainer = bq_components.train_item_matching_model(
-    project_id=project_id,
-    bq_dataset=bq_dataset_name,
-    item_cooc=pmi_computer.outputs.item_cooc,
-    dimensions=dimensions,
-  )
+  output_config = example_gen_pb2.Output(
+    split_config=example_gen_pb2.SplitConfig(splits=[
+      example_gen_pb2.SplitConfig.Split(name='train', hash_buckets=1)]))
   
-  # Extract the embeddings from the BQML model to a table.
-  embeddings_extractor = bq_components.extract_embeddings(
-    project_id=project_id,
-    bq_dataset=bq_dataset_name,
-    bq_model=bqml_trainer.outputs.bq_model
-  )
-  
-  # Export embeddings from BigQuery to Cloud Storage.
-  embeddings_exporter = BigQueryExampleGen(
-    query=f'''
-      SELECT item_Id, embedding, bias,
-      FROM {bq_dataset_name}.item_embeddings
-    ''',
-    output_config=example_gen_pb2.Output(
-      split_config=example_gen_pb2.SplitConfig(splits=[
-        example_gen_pb2.SplitConfig.Split(name='train', hash_buckets=1)]))
-  )
+  if local_data_dir:
+    # Compute the PMI.
+    pmi_computer = local_components.compute_pmi_local(
+      data_dir=local_data_dir,
+      bq_dataset=bq_dataset_name,
+      min_item_frequency=min_item_frequency,
+      max_group_size=max_group_size
+    )
+    
+    # Train the Matrix Factorization model.
+    bqml_trainer = local_components.train_item_matching_model_local(
+      data_dir=local_data_dir,
+      bq_dataset=bq_dataset_name,
+      item_cooc=pmi_computer.outputs.item_cooc,
+      dimensions=dimensions,
+    )
+    
+    # Extract the embeddings from the model to files.
+    embeddings_extractor = local_components.extract_embeddings_local(
+      data_dir=local_data_dir,
+      bq_dataset=bq_dataset_name,
+      bq_model=bqml_trainer.outputs.bq_model
+    )
+    
+    # Import the embedding files.
+    embeddings_exporter = ImportExampleGen(
+      input_base=os.path.join(local_data_dir, local_components.EMBEDDINGS_DIR_NAME),
+      output_config=output_config
+    )
+  else:
+    # Compute the PMI.
+    pmi_computer = bq_components.compute_pmi(
+      project_id=project_id,
+      bq_dataset=bq_dataset_name,
+      min_item_frequency=min_item_frequency,
+      max_group_size=max_group_size
+    )
+    
+    # Train the BQML Matrix Factorization model.
+    bqml_trainer = bq_components.train_item_matching_model(
+      project_id=project_id,
+      bq_dataset=bq_dataset_name,
+      item_cooc=pmi_computer.outputs.item_cooc,
+      dimensions=dimensions,
+    )
+    
+    # Extract the embeddings from the BQML model to a table.
+    embeddings_extractor = bq_components.extract_embeddings(
+      project_id=project_id,
+      bq_dataset=bq_dataset_name,
+      bq_model=bqml_trainer.outputs.bq_model
+    )
+    
+    # Export embeddings from BigQuery to Cloud Storage.
+    embeddings_exporter = BigQueryExampleGen(
+      query=f'''
+        SELECT item_Id, embedding, bias,
+        FROM {bq_dataset_name}.item_embeddings
+      ''',
+      output_config=output_config
+    )
   
   # Add dependency from embeddings_exporter to embeddings_extractor.
   embeddings_exporter.add_upstream_node(embeddings_extractor)
@@ -110,16 +173,28 @@ def create_pipeline(pipeline_name: Text,
     instance_name='ImportSchema',
   )
   
-  # Generate stats for the embeddings for validation.
-  stats_generator = tfx.components.StatisticsGen(
-    examples=embeddings_exporter.outputs.examples,
-  )
+  if enable_stats_validation:
+    # Generate stats for the embeddings for validation.
+    stats_generator = tfx.components.StatisticsGen(
+      examples=embeddings_exporter.outputs.examples,
+    )
 
-  # Validate the embeddings stats against the schema.
-  stats_validator = tfx.components.ExampleValidator(
-    statistics=stats_generator.outputs.statistics,
-    schema=schema_importer.outputs.result,
-  )
+    # Validate the embeddings stats against the schema.
+    stats_validator = tfx.components.ExampleValidator(
+      statistics=stats_generator.outputs.statistics,
+      schema=schema_importer.outputs.result,
+    )
+    validation_components = [stats_generator, stats_validator]
+  else:
+    # Validate the embeddings against the schema.
+    stats_validator = embeddings_validator.validate_embeddings(
+      examples=embeddings_exporter.outputs.examples,
+      schema=schema_importer.outputs.result,
+      min_norm=embeddings_validator.MIN_EMBEDDING_NORM,
+      max_norm=embeddings_validator.MAX_EMBEDDING_NORM,
+    )
+    stats_validator.id = 'ValidateEmbeddings'
+    validation_components = [stats_validator]
 
   # Create an embedding lookup SavedModel.
   embedding_lookup_creator = tfx.components.Trainer(
@@ -128,7 +203,8 @@ def create_pipeline(pipeline_name: Text,
     train_args={'splits': ['train'], 'num_steps': 0},
     eval_args={'splits': ['train'], 'num_steps': 0},
     schema=schema_importer.outputs.result,
-    examples=embeddings_exporter.outputs.examples
+    examples=embeddings_exporter.outputs.examples,
+    custom_config={'embedding_dtype': embedding_dtype}
   )
   embedding_lookup_creator.id = 'CreateEmbeddingLookup'
   
@@ -168,7 +244,13 @@ def create_pipeline(pipeline_name: Text,
     eval_args={'splits': ['train'], 'num_steps': 0},
     schema=schema_importer.outputs.result,
     examples=embeddings_exporter.outputs.examples,
-    custom_config={'ai_platform_training_args': ai_platform_training_args}
+    custom_config={
+      'ai_platform_training_args': ai_platform_training_args,
+      'index_cache_uri': index_cache_uri,
+      'projection_dimensions': projection_dimensions,
+      'projection_method': projection_method,
+      'training_sample_fraction': index_training_sample_fraction
+    }
   )
   scann_indexer.id = 'BuildScaNNIndex'
   
@@ -181,7 +263,12 @@ def create_pipeline(pipeline_name: Text,
     schema=schema_importer.outputs.result,
     model=scann_indexer.outputs.model,
     min_recall=eval_min_recall,
-    max_latency=eval_max_latency
+    max_latency=eval_max_latency,
+    latency_percentile=eval_latency_percentile,
+    load_test_concurrency=eval_load_test_concurrency,
+    max_load_latency=eval_max_load_latency,
+    min_throughput=eval_min_throughput,
+    ground_truth_cache_uri=ground_truth_cache_uri
   )
   
   # Push the ScaNN index to model registry location.
@@ -195,14 +282,33 @@ def create_pipeline(pipeline_name: Text,
   )
   scann_index_pusher.id = 'PushScaNNIndex'
   
+  if enable_fused_model:
+    # Combine the lookup model and the ScaNN index into one SavedModel.
+    fused_model_creator = fused_model.create_fused_model(
+      embedding_lookup=embedding_lookup_creator.outputs.model,
+      scann_index=scann_indexer.outputs.model
+    )
+    fused_model_creator.id = 'CreateFusedModel'
+    
+    # Push the fused model to model registry location.
+    fused_model_pusher = tfx.components.Pusher(
+      model=fused_model_creator.outputs.fused_model,
+      model_blessing=index_evaluator.outputs.blessing,
+      push_destination=tfx.proto.pusher_pb2.PushDestination(
+        filesystem=tfx.proto.pusher_pb2.PushDestination.Filesystem(
+          base_directory=os.path.join(model_regisrty_uri, FUSED_MODEL_NAME))
+      )
+    )
+    fused_model_pusher.id = 'PushFusedModel'
+    fused_model_pusher.add_upstream_node(infra_validator)
+  
   components=[
     pmi_computer,
     bqml_trainer,
     embeddings_extractor,
     embeddings_exporter,
     schema_importer,
-    stats_generator,
-    stats_validator,
+    *validation_components,
     embedding_lookup_creator,
     infra_validator,
     embedding_lookup_pusher,
@@ -211,6 +317,9 @@ def create_pipeline(pipeline_name: Text,
     scann_index_pusher
   ]
   
+  if enable_fused_model:
+    components.extend([fused_model_creator, fused_model_pusher])
+  
   print('The pipeline consists of the following components:')
   print([component.id for component in components])
   
@@ -0,0 +1,159 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sparse item co-occurrence and PMI computation.
+
+Computes the same item_cooc output as the sp_ComputePMI procedure, using a
+sparse group-by-item count matrix instead of a self-join on the item groups.
+"""
+
+import csv
+import logging
+import argparse
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+
+GROUPS_PER_WORKER_CHUNK = 100000
+
+
+def _count_cooc(group_item_counts):
+  return (group_item_counts.T @ group_item_counts).tocsr()
+
+
+def compute_item_cooc(item_ids, group_ids, min_item_frequency, max_group_size, num_workers=None):
+  """Computes item co-occurrence and PMI from (item_Id, group_Id) rows.
+
+  Args:
+    item_ids: A sequence of item Ids, one per item group row.
+    group_ids: A sequence of group Ids, aligned with item_ids.
+    min_item_frequency: Minimum number of rows an item needs to be kept.
+    max_group_size: Maximum number of valid items a group can have to be kept.
+    num_workers: Number of worker processes counting co-occurrences. Defaults
+      to the number of CPUs.
+
+  Returns:
+    A dict of aligned item1_Id, item2_Id, cooc, and pmi arrays, with a row for
+    each ordered item pair that co-occurs, and for each item with itself.
+  """
+  items, item_indices = np.unique(np.asarray(item_ids), return_inverse=True)
+  groups, group_indices = np.unique(np.asarray(group_ids), return_inverse=True)
+  logging.info(f'{len(item_indices)} rows with {len(items)} items and {len(groups)} groups are loaded.')
+
+  # Keep the items with the minimum frequency.
+  item_frequency = np.bincount(item_indices, minlength=len(items))
+  valid_rows = item_frequency[item_indices] >= min_item_frequency
+
+  # Keep the groups with 2 to max_group_size rows of valid items.
+  group_size = np.bincount(group_indices[valid_rows], minlength=len(groups))
+  valid_rows &= (group_size[group_indices] >= 2) & (group_size[group_indices] <= max_group_size)
+
+  valid_items, item_indices = np.unique(item_indices[valid_rows], return_inverse=True)
+  valid_groups, group_indices = np.unique(group_indices[valid_rows], return_inverse=True)
+  items = items[valid_items]
+  logging.info(f'{len(item_indices)} rows with {len(items)} items and {len(valid_groups)} groups are valid.')
+  # As the SQL procedure, no valid groups give no item pairs.
+  if not len(item_indices):
+    return {
+      'item1_Id': items,
+      'item2_Id': items,
+      'cooc': np.array([], dtype=np.int64),
+      'pmi': np.array([], dtype=np.float64),
+    }
+
+  # Count the co-occurrences as (groups x items)^T (groups x items), with the
+  # groups split across the workers.
+  group_item_counts = sparse.csr_matrix(
+    (np.ones(len(item_indices), dtype=np.int64), (group_indices, item_indices)),
+    shape=(len(valid_groups), len(items)))
+  chunks = [
+    group_item_counts[start: start + GROUPS_PER_WORKER_CHUNK]
+    for start in range(0, group_item_counts.shape[0], GROUPS_PER_WORKER_CHUNK)]
+  num_workers = min(num_workers or multiprocessing.cpu_count(), len(chunks))
+  if num_workers > 1:
+    with multiprocessing.Pool(num_workers) as pool:
+      cooc = sum(pool.map(_count_cooc, chunks))
+  else:
+    cooc = sum(_count_cooc(chunk) for chunk in chunks)
+
+  # An item co-occurs with itself as many times as its frequency.
+  frequency = np.asarray(group_item_counts.sum(axis=0)).ravel()
+  cooc = cooc - sparse.diags(cooc.diagonal(), dtype=np.int64)
+  cooc = (cooc + sparse.diags(frequency, dtype=np.int64)).tocoo()
+  cooc.eliminate_zeros()
+  total = frequency.sum()
+
+  pmi = (np.log2(cooc.data) - np.log2(frequency[cooc.row])
+         - np.log2(frequency[cooc.col]) + np.log2(total))
+  logging.info(f'{cooc.nnz} item pairs are computed.')
+
+  return {
+    'item1_Id': items[cooc.row],
+    'item2_Id': items[cooc.col],
+    'cooc': cooc.data,
+    'pmi': pmi,
+  }
+
+
+def read_item_groups(item_groups_file_path):
+  item_ids, group_ids = [], []
+  with open(item_groups_file_path, 'r') as handle:
+    for row in csv.DictReader(handle):
+      item_ids.append(row['item_Id'])
+      group_ids.append(row['group_Id'])
+  return item_ids, group_ids
+
+
+def write_item_cooc(item_cooc, item_cooc_file_path):
+  with open(item_cooc_file_path, 'w', newline='') as handle:
+    writer = csv.writer(handle)
+    writer.writerow(['item1_Id', 'item2_Id', 'cooc', 'pmi'])
+    writer.writerows(zip(
+      item_cooc['item1_Id'], item_cooc['item2_Id'], item_cooc['cooc'], item_cooc['pmi']))
+
+
+def get_args():
+
+  args_parser = argparse.ArgumentParser()
+
+  args_parser.add_argument(
+    '--item-groups-file',
+    help='CSV file with item_Id and group_Id columns',
+    required=True
+  )
+
+  args_parser.add_argument(
+    '--output-file',
+    help='CSV file to write the item_cooc rows to',
+    required=True
+  )
+
+  args_parser.add_argument('--min-item-frequency', default=15, type=int)
+  args_parser.add_argument('--max-group-size', default=100, type=int)
+  args_parser.add_argument('--num-workers', default=None, type=int)
+
+  return args_parser.parse_args()
+
+
+def main():
+  args = get_args()
+  item_ids, group_ids = read_item_groups(args.item_groups_file)
+  item_cooc = compute_item_cooc(
+    item_ids, group_ids, args.min_item_frequency, args.max_group_size, args.num_workers)
+  write_item_cooc(item_cooc, args.output_file)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main()
@@ -81,6 +81,31 @@ if __name__ == '__main__':
       default=0.01,
       ptype=float
   )
+  
+  eval_latency_percentile = data_types.RuntimeParameter(
+      name='eval-latency-percentile',
+      default=95,
+      ptype=int
+  )
+  
+  eval_load_test_concurrency = data_types.RuntimeParameter(
+      name='eval-load-test-concurrency',
+      default=8,
+      ptype=int
+  )
+  
+  # The latency under the load test, at eval-latency-percentile, or 0 to only report it.
+  eval_max_load_latency = data_types.RuntimeParameter(
+      name='eval-max-load-latency',
+      default=0.0,
+      ptype=float
+  )
+  
+  eval_min_throughput = data_types.RuntimeParameter(
+      name='eval-min-throughput',
+      default=0.0,
+      ptype=float
+  )
     
   pipeline_root = f'{config.ARTIFACT_STORE_URI}/{config.PIPELINE_NAME}/{kfp.dsl.RUN_ID_PLACEHOLDER}'
 
@@ -109,5 +134,15 @@ if __name__ == '__main__':
       eval_max_latency=eval_max_latency,
       ai_platform_training_args=ai_platform_training_args,
       beam_pipeline_args=beam_pipeline_args,
-      model_regisrty_uri=config.MODEL_REGISTRY_URI)
+      model_regisrty_uri=config.MODEL_REGISTRY_URI,
+      eval_latency_percentile=eval_latency_percentile,
+      eval_load_test_concurrency=eval_load_test_concurrency,
+      eval_max_load_latency=eval_max_load_latency,
+      eval_min_throughput=eval_min_throughput,
+      ground_truth_cache_uri=f'{config.ARTIFACT_STORE_URI}/{config.PIPELINE_NAME}/ground_truth',
+      enable_fused_model=config.ENABLE_FUSED_MODEL == 'True',
+      index_cache_uri=f'{config.ARTIFACT_STORE_URI}/{config.PIPELINE_NAME}/index_cache',
+      projection_dimensions=int(config.PROJECTION_DIMENSIONS),
+      projection_method=config.PROJECTION_METHOD,
+      index_training_sample_fraction=float(config.INDEX_TRAINING_SAMPLE_FRACTION))
   )
\ No newline at end of file
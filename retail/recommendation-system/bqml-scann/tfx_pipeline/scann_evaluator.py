@@ -14,13 +14,18 @@
 """ScaNN index evaluator custom component."""
 
 import os
+import io
 import time
+import hashlib
+import multiprocessing
+from concurrent import futures
 from typing import Any, Dict, List, Optional, Text, Union
 import logging
 import json
 
 import tfx
 from tfx.types import standard_artifacts
+from tfx.types.experimental.simple_artifacts import Dataset
 from tfx.types.component_spec import ChannelParameter
 from tfx.types.component_spec import ExecutionParameter
 from tfx.dsl.components.base import base_executor
@@ -47,6 +52,14 @@ except:
 QUERIES_SAMPLE_RATIO = 0.01
 MAX_NUM_QUERIES = 10000
 NUM_NEIGBHOURS = 20
+QUERIES_SAMPLE_SEED = 42
+GROUND_TRUTH_FILE_NAME = 'ground_truth.npz'
+NUM_WARMUP_QUERIES = 100
+QUERY_BATCH_SIZE = 100
+LATENCY_PERCENTILES = [50, 95, 99]
+DEFAULT_LATENCY_PERCENTILE = 95
+LOAD_TEST_DURATION_SECONDS = 30
+LOAD_TEST_MODES = ['thread', 'process']
 
 
 class IndexEvaluatorSpec(tfx.types.ComponentSpec):
@@ -60,11 +73,19 @@ class IndexEvaluatorSpec(tfx.types.ComponentSpec):
   OUTPUTS = {
     'evaluation': ChannelParameter(type=standard_artifacts.ModelEvaluation),
     'blessing': ChannelParameter(type=standard_artifacts.ModelBlessing),
+    'ground_truth': ChannelParameter(type=Dataset),
   }
     
   PARAMETERS = {
     'min_recall': ExecutionParameter(type=float),
     'max_latency': ExecutionParameter(type=float),
+    'latency_percentile': ExecutionParameter(type=int, optional=True),
+    'load_test_concurrency': ExecutionParameter(type=int, optional=True),
+    'load_test_duration': ExecutionParameter(type=float, optional=True),
+    'load_test_mode': ExecutionParameter(type=Text, optional=True),
+    'max_load_latency': ExecutionParameter(type=float, optional=True),
+    'min_throughput': ExecutionParameter(type=float, optional=True),
+    'ground_truth_cache_uri': ExecutionParameter(type=Text, optional=True),
   }
 
 
@@ -100,62 +121,169 @@ class ScaNNIndexEvaluatorExecutor(base_executor.BaseExecutor):
     num_embeddings = embeddings.shape[0]
     logging.info(f'{num_embeddings} embeddings are loaded.')
     num_queries = int(min(num_embeddings * QUERIES_SAMPLE_RATIO, MAX_NUM_QUERIES))
-    logging.info(f'Sampling {num_queries} query embeddings for evaluation...')
-    query_embedding_indices = np.random.choice(num_embeddings, num_queries)
-    query_embeddings = np.take(embeddings, query_embedding_indices, axis=0)
+    fingerprint = _compute_fingerprint(vocabulary, embeddings, num_queries)
+    logging.info(f'Embeddings fingerprint: {fingerprint}')
+    
+    ground_truth_cache_uri = exec_properties.get('ground_truth_cache_uri')
+    ground_truth_cache_dir = (
+      os.path.join(ground_truth_cache_uri, fingerprint) if ground_truth_cache_uri else None)
+    ground_truth = _load_ground_truth(ground_truth_cache_dir)
+    ground_truth_cache_hit = ground_truth is not None
+    
+    if ground_truth_cache_hit:
+      logging.info(f'Reusing exact matches from {ground_truth_cache_dir}.')
+      query_embedding_indices, exact_match_indices, exact_match_scores = ground_truth
+    else:
+      logging.info(f'Sampling {num_queries} query embeddings for evaluation...')
+      query_embedding_indices = np.random.RandomState(QUERIES_SAMPLE_SEED).choice(
+        num_embeddings, num_queries, replace=False)
+      
+      # Load Exact matcher
+      exact_matcher = item_matcher.ExactMatcher(embeddings, vocabulary)
+      logging.info(f'Computing exact matches for the queries...')
+      exact_match_indices, exact_match_scores = exact_matcher.match_batch(
+        np.take(embeddings, query_embedding_indices, axis=0), NUM_NEIGBHOURS)
+      logging.info(f'Exact matches are computed.')
+      del exact_matcher
+      
+      if ground_truth_cache_dir:
+        _save_ground_truth(
+          ground_truth_cache_dir, query_embedding_indices, exact_match_indices, exact_match_scores,
+          vocabulary)
+        logging.info(f'Exact matches are cached in {ground_truth_cache_dir}.')
 
-    # Load Exact matcher
-    exact_matcher = item_matcher.ExactMatcher(embeddings, vocabulary)
-    exact_matches = []
-    logging.info(f'Computing exact matches for the queries...')
-    for query in query_embeddings:
-      exact_matches.append(exact_matcher.match(query, NUM_NEIGBHOURS))
-    logging.info(f'Exact matches are computed.')
-    del num_embeddings, exact_matcher
+    query_embeddings = np.take(embeddings, query_embedding_indices, axis=0)
+    exact_matches = [
+      [vocabulary[match_idx] for match_idx in match_indices]
+      for match_indices in exact_match_indices]
+    del num_embeddings
     
     # Load ScaNN index matcher
     index_artifact = artifact_utils.get_single_instance(input_dict['model'])
     ann_matcher = item_matcher.ScaNNMatcher(index_artifact.uri + '/serving_model_dir')
+    
+    logging.info(f'Warming up the ScaNN index with {NUM_WARMUP_QUERIES} queries...')
+    for query in query_embeddings[:NUM_WARMUP_QUERIES]:
+      ann_matcher.match(query, NUM_NEIGBHOURS)
+    ann_matcher.match_batch(query_embeddings[:QUERY_BATCH_SIZE], NUM_NEIGBHOURS)
+    
     scann_matches = []
+    single_query_latencies = []
     logging.info(f'Computing ScaNN matches for the queries...')
-    start_time = time.time()
     for query in query_embeddings:
+      start_time = time.perf_counter()
       scann_matches.append(ann_matcher.match(query, NUM_NEIGBHOURS))
-    end_time = time.time()
+      single_query_latencies.append(time.perf_counter() - start_time)
     logging.info(f'ScaNN matches are computed.')
     
-    # Compute average latency
-    elapsed_time = end_time - start_time
-    current_latency = elapsed_time / num_queries
-
+    batch_latencies = []
+    logging.info(f'Computing batched ScaNN matches with batch size {QUERY_BATCH_SIZE}...')
+    for start in range(0, num_queries, QUERY_BATCH_SIZE):
+      query_batch = query_embeddings[start: start + QUERY_BATCH_SIZE]
+      start_time = time.perf_counter()
+      ann_matcher.match_batch(query_batch, NUM_NEIGBHOURS)
+      batch_latencies.append(time.perf_counter() - start_time)
+    logging.info(f'Batched ScaNN matches are computed.')
+    
+    # Run a closed-loop load test against the index.
+    load_test_concurrency = exec_properties.get('load_test_concurrency') or 0
+    load_test_duration = exec_properties.get(
+      'load_test_duration') or LOAD_TEST_DURATION_SECONDS
+    load_test_mode = exec_properties.get('load_test_mode') or 'thread'
+    load_test_latencies = None
+    if load_test_concurrency > 0:
+      logging.info(f'Running load test with {load_test_concurrency} concurrent {load_test_mode} workers for {load_test_duration} seconds...')
+      load_test_latencies, load_test_throughput = _run_load_test(
+        ann_matcher, index_artifact.uri + '/serving_model_dir', query_embeddings,
+        load_test_concurrency, load_test_duration, load_test_mode)
+      logging.info(f'Load test completed.')
+    
     # Compute recall
     current_recall = 0
     for exact, approx in zip(exact_matches, scann_matches):
       current_recall += len(set(exact).intersection(set(approx))) / NUM_NEIGBHOURS
     current_recall /= num_queries
     
-    metrics = {
-      'recall': current_recall,
-      'latency': current_latency
-    }
+    metrics = {'recall': current_recall}
+    
+    # Report the build cost next to the recall, if the indexer profiled the build.
+    profile_file_path = os.path.join(
+      index_artifact.uri, 'serving_model_dir', scann_indexer.PROFILE_FILE_NAME)
+    if tf.io.gfile.exists(profile_file_path):
+      build_profile = json.loads(io_utils.read_string_file(profile_file_path))
+      metrics['build_time'] = build_profile['total']
+      metrics['build_peak_rss_bytes'] = build_profile['peak_rss_bytes']
+      metrics['index_size_bytes'] = build_profile['output_size_bytes']
+    
+    # Measure the recall lost by projecting the embeddings, independently of
+    # the ScaNN approximation, with an exact search over the projected vectors.
+    if ann_matcher.projection is not None:
+      logging.info(f'Computing exact matches for the queries in the projected space...')
+      projected_matcher = item_matcher.ExactMatcher(ann_matcher.project(embeddings), vocabulary)
+      projected_match_indices, _ = projected_matcher.match_batch(
+        ann_matcher.project(query_embeddings), NUM_NEIGBHOURS)
+      del projected_matcher
+      projection_recall = np.mean([
+        len(set(exact).intersection(set(projected))) / NUM_NEIGBHOURS
+        for exact, projected in zip(exact_match_indices, projected_match_indices)])
+      metrics['projection_dimensions'] = int(ann_matcher.projection[1].shape[1])
+      metrics['projection_recall'] = float(projection_recall)
+      logging.info(f'Recall of exact matching in {metrics["projection_dimensions"]} dimensions: {projection_recall}')
+    metrics.update(_latency_metrics('', single_query_latencies, num_queries))
+    metrics.update(_latency_metrics('batch_', batch_latencies, num_queries))
+    if load_test_latencies is not None:
+      metrics.update(_latency_metrics('load_', load_test_latencies, len(load_test_latencies)))
+      metrics['load_throughput'] = load_test_throughput
+      metrics['load_concurrency'] = load_test_concurrency
+    logging.info(f'Evaluation metrics: {metrics}')
     
     min_recall = exec_properties['min_recall']
     max_latency = exec_properties['max_latency']
+    latency_percentile = exec_properties.get(
+      'latency_percentile') or DEFAULT_LATENCY_PERCENTILE
+    min_throughput = exec_properties.get('min_throughput') or 0.
+    max_load_latency = exec_properties.get('max_load_latency') or 0.
+    # The latency is measured one query at a time, and is gated by max_latency.
+    # The latency under load is gated separately, by max_load_latency if set.
+    current_latency = float(np.percentile(single_query_latencies, latency_percentile))
+    current_throughput = (
+      load_test_throughput if load_test_latencies is not None else metrics['throughput'])
+    metrics['latency'] = current_latency
+    valid_load_latency = True
+    if load_test_latencies is not None:
+      current_load_latency = float(np.percentile(load_test_latencies, latency_percentile))
+      metrics['load_latency'] = current_load_latency
+      if max_load_latency:
+        valid_load_latency = current_load_latency <= max_load_latency
+      logging.info(f'p{latency_percentile} latency per query under load achieved {current_load_latency}. Maximum latency allowed: {max_load_latency or None}')
     
-    logging.info(f'Average latency per query achieved {current_latency}. Maximum latency allowed: {max_latency}')
+    logging.info(f'p{latency_percentile} latency per query achieved {current_latency}. Maximum latency allowed: {max_latency}')
+    logging.info(f'Throughput achieved {current_throughput}. Minimum throughput allowed: {min_throughput}')
     logging.info(f'Recall acheived {current_recall}. Minimum recall allowed: {min_recall}')
     
-    # Validate index latency and recall
-    valid = (current_latency <= max_latency) and (current_recall >= min_recall)
+    # Validate index latency, throughput, and recall
+    valid = ((current_latency <= max_latency) 
+             and valid_load_latency
+             and (current_throughput >= min_throughput)
+             and (current_recall >= min_recall))
     logging.info(f'Model is valid: {valid}')
     
     # Output the evaluation artifact.
     evaluation = artifact_utils.get_single_instance(output_dict['evaluation'])
     evaluation.set_string_custom_property('index_model_uri', index_artifact.uri)
     evaluation.set_int_custom_property('index_model_id', index_artifact.id)
+    evaluation.set_string_custom_property('embeddings_fingerprint', fingerprint)
     io_utils.write_string_file(
       os.path.join(evaluation.uri, 'metrics'), json.dumps(metrics))
     
+    # Output the ground truth artifact.
+    ground_truth_artifact = artifact_utils.get_single_instance(output_dict['ground_truth'])
+    ground_truth_artifact.set_string_custom_property('embeddings_fingerprint', fingerprint)
+    ground_truth_artifact.set_int_custom_property('cache_hit', int(ground_truth_cache_hit))
+    _save_ground_truth(
+      ground_truth_artifact.uri, query_embedding_indices, exact_match_indices, exact_match_scores,
+      vocabulary)
+    
     # Output the blessing artifact.
     blessing = artifact_utils.get_single_instance(output_dict['blessing'])
     blessing.set_string_custom_property('index_model_uri', index_artifact.uri)
@@ -169,6 +297,102 @@ class ScaNNIndexEvaluatorExecutor(base_executor.BaseExecutor):
       blessing.set_int_custom_property('blessed', 0)
 
 
+def _compute_fingerprint(vocabulary, embeddings, num_queries):
+  """Fingerprints the embeddings together with the query sampling settings."""
+  hasher = hashlib.sha256()
+  hasher.update(f'{num_queries},{NUM_NEIGBHOURS},{QUERIES_SAMPLE_SEED}'.encode())
+  hasher.update('\n'.join(vocabulary).encode())
+  hasher.update(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+  return hasher.hexdigest()
+
+
+def _load_ground_truth(ground_truth_dir):
+  if not ground_truth_dir:
+    return None
+  ground_truth_file_path = os.path.join(ground_truth_dir, GROUND_TRUTH_FILE_NAME)
+  if not tf.io.gfile.exists(ground_truth_file_path):
+    return None
+  with tf.io.gfile.GFile(ground_truth_file_path, 'rb') as handle:
+    ground_truth = np.load(io.BytesIO(handle.read()))
+    return ground_truth['query_indices'], ground_truth['match_indices'], ground_truth['match_scores']
+
+
+def _save_ground_truth(ground_truth_dir, query_indices, match_indices, match_scores, vocabulary):
+  buffer = io.BytesIO()
+  np.savez(
+    buffer, 
+    query_indices=query_indices, 
+    match_indices=match_indices, 
+    match_scores=match_scores,
+    query_ids=np.array(vocabulary)[query_indices],
+    match_ids=np.array(vocabulary)[match_indices])
+  tf.io.gfile.makedirs(ground_truth_dir)
+  ground_truth_file_path = os.path.join(ground_truth_dir, GROUND_TRUTH_FILE_NAME)
+  with tf.io.gfile.GFile(ground_truth_file_path, 'wb') as handle:
+    handle.write(buffer.getvalue())
+
+
+def _latency_metrics(prefix, latencies, num_queries):
+  """Summarizes the measured search latencies into percentiles and throughput."""
+  metrics = {
+    f'{prefix}latency_mean': float(np.mean(latencies)),
+    f'{prefix}throughput': num_queries / float(np.sum(latencies)),
+  }
+  for percentile in LATENCY_PERCENTILES:
+    metrics[f'{prefix}latency_p{percentile}'] = float(
+      np.percentile(latencies, percentile))
+  return metrics
+
+
+def _load_test_worker(ann_matcher, index_dir, queries, worker_idx, duration):
+  """Issues queries back to back for the given duration, in a closed loop."""
+  if ann_matcher is None:
+    ann_matcher = item_matcher.ScaNNMatcher(index_dir)
+    ann_matcher.match(queries[0], NUM_NEIGBHOURS)
+  latencies = []
+  query_idx = worker_idx
+  start_time = time.perf_counter()
+  end_time = start_time + duration
+  while time.perf_counter() < end_time:
+    query = queries[query_idx % len(queries)]
+    query_start_time = time.perf_counter()
+    ann_matcher.match(query, NUM_NEIGBHOURS)
+    latencies.append(time.perf_counter() - query_start_time)
+    query_idx += 1
+  return latencies, time.perf_counter() - start_time
+
+
+def _run_load_test(ann_matcher, index_dir, queries, concurrency, duration, mode):
+  """Runs concurrent workers against the index and returns latencies and throughput.
+  
+  Thread workers share the loaded matcher, as the index server threads do.
+  Process workers each load their own copy of the index, as separate
+  replicas on the same node do.
+  """
+  if mode not in LOAD_TEST_MODES:
+    raise ValueError(f'Unsupported load test mode: {mode}. Supported modes: {LOAD_TEST_MODES}')
+  
+  if mode == 'thread':
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+  else:
+    ann_matcher = None
+    executor = futures.ProcessPoolExecutor(
+      max_workers=concurrency, mp_context=multiprocessing.get_context('spawn'))
+
+  with executor:
+    results = list(executor.map(
+      _load_test_worker,
+      [ann_matcher] * concurrency,
+      [index_dir] * concurrency,
+      [queries] * concurrency,
+      range(concurrency),
+      [duration] * concurrency))
+  
+  latencies = [latency for worker_latencies, _ in results for latency in worker_latencies]
+  throughput = sum(len(worker_latencies) / elapsed_time for worker_latencies, elapsed_time in results)
+  return latencies, throughput
+
+
 class IndexEvaluator(base_component.BaseComponent):
   
   SPEC_CLASS = IndexEvaluatorSpec
@@ -180,8 +404,16 @@ class IndexEvaluator(base_component.BaseComponent):
                model: types.channel,
                min_recall: float,
                max_latency: float,
+               latency_percentile: Optional[int] = DEFAULT_LATENCY_PERCENTILE,
+               load_test_concurrency: Optional[int] = None,
+               load_test_duration: Optional[float] = LOAD_TEST_DURATION_SECONDS,
+               load_test_mode: Optional[Text] = 'thread',
+               max_load_latency: Optional[float] = None,
+               min_throughput: Optional[float] = None,
+               ground_truth_cache_uri: Optional[Text] = None,
                evaluation: Optional[types.Channel] = None,
                blessing: Optional[types.Channel] = None,
+               ground_truth: Optional[types.Channel] = None,
                instance_name=None):
     
     blessing = blessing or types.Channel(
@@ -192,14 +424,26 @@ class IndexEvaluator(base_component.BaseComponent):
       type=standard_artifacts.ModelEvaluation,
       artifacts=[standard_artifacts.ModelEvaluation()])
     
+    ground_truth = ground_truth or types.Channel(
+      type=Dataset,
+      artifacts=[Dataset()])
+    
     spec = IndexEvaluatorSpec(
       examples=examples, 
       schema=schema,
       model=model, 
       evaluation=evaluation,
       blessing=blessing, 
+      ground_truth=ground_truth,
       min_recall=min_recall, 
-      max_latency=max_latency
+      max_latency=max_latency,
+      latency_percentile=latency_percentile,
+      load_test_concurrency=load_test_concurrency,
+      load_test_duration=load_test_duration,
+      load_test_mode=load_test_mode,
+      max_load_latency=max_load_latency,
+      min_throughput=min_throughput,
+      ground_truth_cache_uri=ground_truth_cache_uri
     )
         
     super().__init__(spec=spec, instance_name=instance_name)
\ No newline at end of file
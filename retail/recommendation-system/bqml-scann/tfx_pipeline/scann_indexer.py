@@ -14,6 +14,7 @@
 """ScaNN index builder."""
 
 import os
+import io
 import sys
 import scann
 import tensorflow as tf
@@ -23,6 +24,11 @@ import numpy as np
 import math
 import pickle
 import logging
+import hashlib
+import json
+import time
+import resource
+import contextlib
 
 METRIC = 'dot_product'
 DIMENSIONS_PER_BLOCK = 2
@@ -31,6 +37,15 @@ NUM_NEIGHBOURS = 10
 NUM_LEAVES_TO_SEARCH = 250
 REORDER_NUM_NEIGHBOURS = 250
 TOKENS_FILE_NAME = 'tokens'
+FINGERPRINT_FILE_NAME = 'fingerprint.json'
+PROFILE_FILE_NAME = 'profile.json'
+TRAINING_SAMPLE_FRACTION = 1.0
+PROJECTION_FILE_NAME = 'projection.npz'
+EMBEDDINGS_FILE_NAME = 'embeddings.npy'
+SEARCH_CONFIG_FILE_NAME = 'search_config.json'
+PROJECTION_METHODS = ['pca', 'random']
+PROJECTION_SAMPLE_SIZE = 100000
+PROJECTION_SEED = 0
 
 
 def load_embeddings(embedding_files_pattern, schema_file_path):
@@ -68,18 +83,101 @@ def load_embeddings(embedding_files_pattern, schema_file_path):
   return vocabulary, embeddings
     
     
-def build_index(embeddings, num_leaves):
+def fit_projection(embeddings, dimensions, method='pca'):
+  """Fits a linear projection of the embeddings to fewer dimensions.
+
+  PCA is fitted on a sample of at most PROJECTION_SAMPLE_SIZE embeddings. The
+  random projection is a Gaussian matrix with orthonormal columns. Neither is
+  centered: subtracting a mean would change the dot products the index ranks
+  by, so only the dropped components cost recall.
+
+  Returns:
+    A tuple of (mean, components), where mean is zero and components has the
+    shape [embedding dimensions, projected dimensions].
+  """
+  if method not in PROJECTION_METHODS:
+    raise ValueError(f'Unsupported projection method: {method}. Supported methods: {PROJECTION_METHODS}')
+  
+  random = np.random.RandomState(PROJECTION_SEED)
+  embedding_dimensions = embeddings.shape[1]
+  dimensions = min(dimensions, embedding_dimensions)
+  
+  if method == 'pca':
+    sample_size = min(embeddings.shape[0], PROJECTION_SAMPLE_SIZE)
+    sample = embeddings[random.choice(embeddings.shape[0], sample_size, replace=False)]
+    _, singular_values, right = np.linalg.svd(sample, full_matrices=False)
+    components = right[:dimensions].T
+    explained_energy = np.sum(singular_values[:dimensions] ** 2) / np.sum(singular_values ** 2)
+    logging.info(f'PCA projection keeps {explained_energy:.4f} of the squared norms.')
+  else:
+    components, _ = np.linalg.qr(random.normal(size=(embedding_dimensions, dimensions)))
+  mean = np.zeros(embedding_dimensions)
+  
+  return mean.astype(np.float32), components.astype(np.float32)
+
+
+def project_embeddings(embeddings, mean, components):
+  """Projects and re-normalizes the embeddings."""
+  projected = np.dot(np.asarray(embeddings, dtype=np.float32) - mean, components)
+  return projected / np.linalg.norm(projected, axis=1, keepdims=True)
+
+
+def save_projection(mean, components, output_dir):
+  projection_file_path = os.path.join(output_dir, PROJECTION_FILE_NAME)
+  buffer = io.BytesIO()
+  np.savez(buffer, mean=mean, components=components)
+  with tf.io.gfile.GFile(projection_file_path, 'wb') as handle:
+    handle.write(buffer.getvalue())
+  logging.info(f'Projection is saved to {projection_file_path}.')
+
+
+def save_embeddings(embeddings, output_dir):
+  """Saves the indexed embeddings, which the index server can match exactly."""
+  embeddings_file_path = os.path.join(output_dir, EMBEDDINGS_FILE_NAME)
+  buffer = io.BytesIO()
+  np.save(buffer, np.asarray(embeddings, dtype=np.float32))
+  with tf.io.gfile.GFile(embeddings_file_path, 'wb') as handle:
+    handle.write(buffer.getvalue())
+  logging.info(f'Embeddings are saved to {embeddings_file_path}.')
+
+
+@contextlib.contextmanager
+def _profile_phase(profile, phase):
+  start_time = time.perf_counter()
+  yield
+  profile[phase] = time.perf_counter() - start_time
+  logging.info(f'Phase {phase} took {profile[phase]:.2f} seconds.')
+
+
+def get_num_leaves(data_size, num_leaves):
+  """Returns the number of leaves of the index, the square root of its size by default."""
+  return num_leaves or int(math.sqrt(data_size))
+
+
+def save_search_config(num_leaves, output_dir):
+  """Saves the leaves and default search effort, which the index server scales down under load."""
+  search_config_file_path = os.path.join(output_dir, SEARCH_CONFIG_FILE_NAME)
+  with tf.io.gfile.GFile(search_config_file_path, 'w') as handle:
+    handle.write(json.dumps({
+      'num_leaves': num_leaves,
+      'num_leaves_to_search': NUM_LEAVES_TO_SEARCH,
+      'reorder_num_neighbours': REORDER_NUM_NEIGHBOURS,
+    }))
+
+
+def build_index(embeddings, num_leaves, training_sample_fraction=TRAINING_SAMPLE_FRACTION):
   
   data_size = embeddings.shape[0] 
-  if not num_leaves:
-    num_leaves = int(math.sqrt(data_size))
-  logging.info(f'Indexing {data_size} embeddings with {num_leaves} leaves.')
+  num_leaves = get_num_leaves(data_size, num_leaves)
+  # The partitioning tree needs at least one training sample per leaf.
+  training_sample_size = min(data_size, max(num_leaves, int(data_size * training_sample_fraction)))
+  logging.info(f'Indexing {data_size} embeddings with {num_leaves} leaves, trained on {training_sample_size} samples.')
     
   logging.info('Start building the ScaNN index...')
   scann_builder = scann.scann_ops.builder(embeddings, NUM_NEIGHBOURS, METRIC).tree(
     num_leaves=num_leaves, 
     num_leaves_to_search=NUM_LEAVES_TO_SEARCH, 
-    training_sample_size=data_size).score_ah(
+    training_sample_size=training_sample_size).score_ah(
       DIMENSIONS_PER_BLOCK,
       anisotropic_quantization_threshold=ANISOTROPIC_QUANTIZATION_THRESHOLD).reorder(REORDER_NUM_NEIGHBOURS)
   scann_index = scann_builder.build()
@@ -88,20 +186,81 @@ def build_index(embeddings, num_leaves):
   return scann_index
 
 
-def save_index(index, tokens, output_dir):
-  logging.info('Saving index as a SavedModel...')
-  module = index.serialize_to_module()
-  tf.saved_model.save(
-    module, output_dir, signatures=None, options=None
-  )
-  logging.info(f'Index is saved to {output_dir}')
+def save_index(index, tokens, output_dir, profile=None):
+  profile = {} if profile is None else profile
   
-  logging.info(f'Saving tokens file...')
-  tokens_file_path = os.path.join(output_dir, TOKENS_FILE_NAME)
-  with tf.io.gfile.GFile(tokens_file_path, 'wb') as handle:
-    pickle.dump(tokens, handle, protocol=pickle.HIGHEST_PROTOCOL)
-  logging.info(f'Item file is saved to {tokens_file_path}.')
+  with _profile_phase(profile, 'serialization'):
+    logging.info('Saving index as a SavedModel...')
+    module = index.serialize_to_module()
+    tf.saved_model.save(
+      module, output_dir, signatures=None, options=None
+    )
+    logging.info(f'Index is saved to {output_dir}')
+  
+  with _profile_phase(profile, 'token_save'):
+    logging.info(f'Saving tokens file...')
+    tokens_file_path = os.path.join(output_dir, TOKENS_FILE_NAME)
+    with tf.io.gfile.GFile(tokens_file_path, 'wb') as handle:
+      pickle.dump(tokens, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    logging.info(f'Item file is saved to {tokens_file_path}.')
+
+
+def compute_fingerprint(tokens, embeddings, num_leaves, projection_dimensions=0, projection_method=None,
+                        training_sample_fraction=TRAINING_SAMPLE_FRACTION):
+  """Fingerprints the embeddings and the ScaNN settings, independently of row order."""
+  hasher = hashlib.sha256()
+  hasher.update(json.dumps([
+    METRIC, DIMENSIONS_PER_BLOCK, ANISOTROPIC_QUANTIZATION_THRESHOLD, NUM_NEIGHBOURS,
+    NUM_LEAVES_TO_SEARCH, REORDER_NUM_NEIGHBOURS, num_leaves]).encode())
+  if training_sample_fraction != TRAINING_SAMPLE_FRACTION:
+    hasher.update(json.dumps([training_sample_fraction]).encode())
+  if projection_dimensions:
+    hasher.update(json.dumps([
+      projection_dimensions, projection_method, PROJECTION_SAMPLE_SIZE, PROJECTION_SEED]).encode())
+  for idx in np.argsort(tokens, kind='stable'):
+    hasher.update(tokens[idx].encode())
+    hasher.update(np.asarray(embeddings[idx], dtype=np.float32).tobytes())
+  return hasher.hexdigest()
+
 
+def _copy_dir(source_dir, target_dir, exclude=()):
+  for dir_name, _, file_names in tf.io.gfile.walk(source_dir):
+    relative_dir = os.path.relpath(dir_name, source_dir)
+    tf.io.gfile.makedirs(os.path.join(target_dir, relative_dir))
+    for file_name in file_names:
+      if relative_dir == '.' and file_name in exclude:
+        continue
+      tf.io.gfile.copy(
+        os.path.join(dir_name, file_name), 
+        os.path.join(target_dir, relative_dir, file_name), 
+        overwrite=True)
+
+
+def _get_dir_size(dir_path):
+  return sum(
+    tf.io.gfile.stat(os.path.join(dir_name, file_name)).length
+    for dir_name, _, file_names in tf.io.gfile.walk(dir_path)
+    for file_name in file_names)
+
+
+def _write_profile(output_dir, profile, reused):
+  """Writes the phase wall times, peak RSS, and output size of the build."""
+  profile = {
+    'phases': profile,
+    'total': sum(profile.values()),
+    # ru_maxrss is in kilobytes on Linux.
+    'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    'output_size_bytes': _get_dir_size(output_dir),
+    'reused': reused,
+  }
+  with tf.io.gfile.GFile(os.path.join(output_dir, PROFILE_FILE_NAME), 'w') as handle:
+    handle.write(json.dumps(profile))
+  logging.info(f'Index build profile: {profile}')
+
+
+def _write_fingerprint(output_dir, fingerprint, reused):
+  with tf.io.gfile.GFile(os.path.join(output_dir, FINGERPRINT_FILE_NAME), 'w') as handle:
+    handle.write(json.dumps({'fingerprint': fingerprint, 'reused': reused}))
 
   
 # TFX will call this function
@@ -110,11 +269,56 @@ def run_fn(params):
   output_dir = params.serving_model_dir
   num_leaves = params.train_steps
   schema_file_path = params.schema_file
+  custom_config = params.custom_config or {}
+  index_cache_uri = custom_config.get('index_cache_uri')
+  projection_dimensions = custom_config.get('projection_dimensions') or 0
+  projection_method = custom_config.get('projection_method') or 'pca'
+  training_sample_fraction = custom_config.get(
+    'training_sample_fraction') or TRAINING_SAMPLE_FRACTION
+  profile = {}
   
   logging.info("Indexer started...")
-  tokens, embeddings = load_embeddings(embedding_files_path, schema_file_path)
-  index = build_index(embeddings, num_leaves)
-  save_index(index, tokens, output_dir)
+  with _profile_phase(profile, 'load'):
+    tokens, embeddings = load_embeddings(embedding_files_path, schema_file_path)
+    fingerprint = compute_fingerprint(
+      tokens, embeddings, num_leaves, projection_dimensions, projection_method,
+      training_sample_fraction)
+  logging.info(f'Embeddings and index settings fingerprint: {fingerprint}')
+  cached_index_dir = os.path.join(index_cache_uri, fingerprint) if index_cache_uri else None
+  
+  reused = bool(
+    cached_index_dir and tf.io.gfile.exists(os.path.join(cached_index_dir, FINGERPRINT_FILE_NAME)))
+  if reused:
+    logging.info(f'Reusing the index built from the same inputs in {cached_index_dir}.')
+    with _profile_phase(profile, 'cache_copy'):
+      _copy_dir(cached_index_dir, output_dir)
+    _write_fingerprint(output_dir, fingerprint, reused=True)
+  else:
+    projection = None
+    if projection_dimensions:
+      with _profile_phase(profile, 'projection'):
+        logging.info(f'Projecting embeddings to {projection_dimensions} dimensions with {projection_method}...')
+        projection = fit_projection(embeddings, projection_dimensions, projection_method)
+        embeddings = project_embeddings(embeddings, *projection)
+        logging.info('Embeddings are projected.')
+    # ScaNN trains the partitions, quantizes, and prepares the reorder data in
+    # a single build call, so these phases are timed together.
+    with _profile_phase(profile, 'build'):
+      index = build_index(embeddings, num_leaves, training_sample_fraction)
+    save_index(index, tokens, output_dir, profile)
+    save_search_config(get_num_leaves(embeddings.shape[0], num_leaves), output_dir)
+    with _profile_phase(profile, 'embeddings_save'):
+      save_embeddings(embeddings, output_dir)
+    if projection is not None:
+      save_projection(*projection, output_dir)
+    _write_fingerprint(output_dir, fingerprint, reused=False)
+    if cached_index_dir:
+      # The fingerprint file marks a complete cache entry, so it is written
+      # last, after all the index files are copied.
+      _copy_dir(output_dir, cached_index_dir, exclude=[FINGERPRINT_FILE_NAME])
+      _write_fingerprint(cached_index_dir, fingerprint, reused=False)
+      logging.info(f'Index is cached in {cached_index_dir}.')
+  _write_profile(output_dir, profile, reused)
   logging.info("Indexer finished.")
     
     